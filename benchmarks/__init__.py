@@ -0,0 +1,12 @@
+"""
+Benchmarks of Cornea's recognition, training and serving hot paths.
+
+Every benchmark runs locally on synthetic faces, so no network access or
+training data is needed. Run them all from the root of the repository with:
+
+    python -m benchmarks --output results.json
+
+or one at a time with python -m benchmarks.model, benchmarks.training or
+benchmarks.server. Results are written as JSON so that they can be compared
+between releases.
+"""
@@ -0,0 +1,17 @@
+"""Run every benchmark and report the results together."""
+from benchmarks import model, training, server, startup
+from benchmarks.common import create_argument_parser, report
+
+
+def main() -> None:
+    args = create_argument_parser(__doc__).parse_args()
+    report({
+        "handle_frame": model.run(args.quick),
+        "training": training.run(args.quick),
+        "detect_frame": server.run(args.quick),
+        "startup": startup.run(args.quick)
+    }, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""Helpers shared by the benchmarks for timing code and reporting results."""
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import subprocess
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+import cv2
+import numpy as np
+
+from cornea.config import Config
+from cornea.model import Model
+from benchmarks.synthetic import synthetic_crops
+
+Result = Dict[str, Any]
+
+
+def summarise(durations: Sequence[float]) -> Dict[str, float]:
+    """Summarise a list of durations in seconds as milliseconds."""
+    ms = np.asarray(durations) * 1000
+    return {
+        "runs": len(ms),
+        "mean_ms": float(ms.mean()),
+        "p50_ms": float(np.percentile(ms, 50)),
+        "p95_ms": float(np.percentile(ms, 95)),
+        "min_ms": float(ms.min()),
+        "max_ms": float(ms.max())
+    }
+
+
+def measure(
+        func: Callable[[], Any],
+        repeat: int,
+        warmup: int = 1) -> Dict[str, float]:
+    """Time repeat calls of a function after warmup untimed calls."""
+    for _ in range(warmup):
+        func()
+
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - start)
+    return summarise(durations)
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+            check=True, cwd=os.path.dirname(__file__)).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def environment() -> Dict[str, Any]:
+    """Describe the machine and versions the benchmarks ran with."""
+    return {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "numpy": np.__version__,
+        "opencv": cv2.__version__
+    }
+
+
+def report(
+        benchmarks: Dict[str, List[Result]],
+        output: Optional[str] = None) -> None:
+    """Write the results of benchmarks as JSON to a file or stdout."""
+    document = {"environment": environment(), "benchmarks": benchmarks}
+    if output is None:
+        json.dump(document, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+        return
+
+    with open(output, "w") as output_file:
+        json.dump(document, output_file, indent=2)
+
+
+def create_argument_parser(description: str) -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument(
+        "--output", help="Write the results to this file instead of stdout")
+    parser.add_argument(
+        "--quick", action="store_true",
+        help="Run fewer and shorter cases, to check that the benchmarks work")
+    return parser
+
+
+def benchmark_config(model_dir: str, **sections: Any) -> Config:
+    """
+    Build a config using model_dir, with any sections overridden. No database
+    is configured unless a database section is given.
+    """
+    config = {
+        "model_default_path": model_dir,
+        "database": {},
+        "people": {},
+        "model_watcher": {"interval": 0}
+    }
+    config.update(sections)
+    return Config(config)
+
+
+def train_synthetic_model(
+        config: Config,
+        people: int,
+        per_person: int) -> Model:
+    """Train a model on synthetic faces into the config's model directory."""
+    model = Model(None, config, False)
+    model.train(synthetic_crops(people, per_person), reload=True)
+    return model
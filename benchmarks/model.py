@@ -0,0 +1,94 @@
+"""
+Benchmark Model.handle_frame on synthetic JPEG frames across frame sizes and
+numbers of faces, timing single frames and the throughput of the inference
+executor with one worker per CPU.
+"""
+import os
+import time
+import asyncio
+import tempfile
+from typing import Callable, List, Optional
+
+from cornea.executor import InferenceExecutor
+from benchmarks.common import (
+    Result, create_argument_parser, benchmark_config, measure, report,
+    train_synthetic_model)
+from benchmarks.synthetic import synthetic_frame, encode_jpeg
+
+RESOLUTIONS = [(320, 240), (640, 480), (1280, 720), (1920, 1080)]
+FACE_COUNTS = [0, 1, 4, 8]
+
+# The size of the model frames are recognised against.
+PEOPLE = 20
+PER_PERSON = 10
+
+
+async def _throughput(
+        executor: InferenceExecutor,
+        func: Callable[[bytes], object],
+        frame: bytes,
+        frames: int) -> float:
+    """Handle frames through the executor, returning frames per second."""
+    concurrency = executor.capacity
+    remaining = frames
+
+    async def client() -> None:
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            await executor.run(func, frame)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    return frames / (time.perf_counter() - start)
+
+
+def run(quick: bool = False, workers: Optional[int] = None) -> List[Result]:
+    resolutions = RESOLUTIONS[:2] if quick else RESOLUTIONS
+    face_counts = FACE_COUNTS[:2] if quick else FACE_COUNTS
+    repeat = 5 if quick else 30
+    workers = workers or os.cpu_count() or 1
+
+    results = []
+    with tempfile.TemporaryDirectory() as model_dir:
+        config = benchmark_config(model_dir)
+        model = train_synthetic_model(
+            config, PEOPLE, 2 if quick else PER_PERSON)
+        executor = InferenceExecutor(workers, queue_size=workers)
+
+        try:
+            for width, height in resolutions:
+                for faces in face_counts:
+                    frame = encode_jpeg(synthetic_frame(width, height, faces))
+                    found = len(model.handle_frame(frame))
+                    latency = measure(
+                        lambda: model.handle_frame(frame), repeat)
+                    fps = asyncio.run(_throughput(
+                        executor, model.handle_frame, frame, repeat * workers))
+                    results.append({
+                        "width": width,
+                        "height": height,
+                        "faces": faces,
+                        "faces_found": found,
+                        "frame_bytes": len(frame),
+                        "latency": latency,
+                        "workers": workers,
+                        "frames_per_second": fps
+                    })
+        finally:
+            executor.shutdown()
+
+    return results
+
+
+def main() -> None:
+    parser = create_argument_parser(__doc__)
+    parser.add_argument(
+        "--workers", type=int,
+        help="Inference workers for the throughput runs, one per CPU if unset")
+    args = parser.parse_args()
+    report({"handle_frame": run(args.quick, args.workers)}, args.output)
+
+
+if __name__ == "__main__":
+    main()
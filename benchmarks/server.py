@@ -0,0 +1,197 @@
+"""
+Benchmark end to end /model/detect_frame requests against a local server,
+measuring requests per second and latency at several levels of concurrency.
+
+The server runs in a separate process on a model trained on synthetic faces.
+It only connects to a Postgres database if one is given with the --database-*
+options, which should be a throwaway instance as the server creates its tables
+there. Otherwise, or if the database is not reachable, it runs without one and
+faces are returned without names.
+"""
+import sys
+import time
+import asyncio
+import tempfile
+import multiprocessing
+import urllib.request
+from urllib.error import URLError
+from typing import Any, Dict, List, Optional, Tuple
+
+from benchmarks.common import (
+    Result, create_argument_parser, benchmark_config, report, summarise,
+    train_synthetic_model)
+from benchmarks.synthetic import synthetic_frame, encode_jpeg
+
+HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+CONCURRENCY = [1, 4, 16, 64]
+DURATION = 10.0
+STARTUP_TIMEOUT = 60.0
+
+PEOPLE = 20
+PER_PERSON = 10
+
+# Used for any --database-* options which are not given.
+DEFAULT_DATABASE_PORT = 5432
+DEFAULT_DATABASE_NAME = "cornea"
+DEFAULT_DATABASE_USER = "postgres"
+
+
+def _serve(config_dict: Dict[str, Any], port: int, workers: int) -> None:
+    # Sanic logs to stdout, keep its logs out of the results.
+    sys.stdout = sys.stderr
+
+    # Imported here so that only the server process loads the server.
+    from cornea import server
+    from cornea.config import Config
+    from cornea.model import Model
+
+    config = Config(config_dict)
+    app = server.create_server(Model(None, config), config)
+    app.run(host=HOST, port=port, workers=workers, access_log=False)
+
+
+def _get(port: int, path: str) -> str:
+    with urllib.request.urlopen(f"http://{HOST}:{port}{path}") as response:
+        return response.read().decode()
+
+
+def _wait_for_server(port: int, process: multiprocessing.Process) -> None:
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while time.monotonic() < deadline:
+        if not process.is_alive():
+            raise RuntimeError("The server exited while starting.")
+        try:
+            _get(port, "/")
+            return
+        except (URLError, ConnectionError):
+            time.sleep(0.2)
+    raise RuntimeError("The server did not start in time.")
+
+
+async def _client(
+        port: int,
+        request: bytes,
+        deadline: float,
+        latencies: List[float],
+        statuses: Dict[int, int]) -> None:
+    """Send requests one after another on a keep-alive connection."""
+    reader, writer = await asyncio.open_connection(HOST, port)
+    try:
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            writer.write(request)
+            await writer.drain()
+
+            head = await reader.readuntil(b"\r\n\r\n")
+            lines = head.decode("latin-1").split("\r\n")
+            status = int(lines[0].split()[1])
+            headers = dict(line.split(":", 1) for line in lines[1:] if line)
+            length = int({key.lower(): value for key, value in
+                          headers.items()}["content-length"])
+            await reader.readexactly(length)
+
+            statuses[status] = statuses.get(status, 0) + 1
+            if status == 200:
+                latencies.append(time.perf_counter() - start)
+    finally:
+        writer.close()
+
+
+async def _load(
+        port: int,
+        frame: bytes,
+        concurrency: int,
+        duration: float) -> Tuple[List[float], Dict[int, int], float]:
+    request = (
+        f"POST /model/detect_frame HTTP/1.1\r\n"
+        f"Host: {HOST}:{port}\r\n"
+        f"Content-Type: image/jpeg\r\n"
+        f"Content-Length: {len(frame)}\r\n\r\n"
+    ).encode() + frame
+    latencies: List[float] = []
+    statuses: Dict[int, int] = {}
+
+    start = time.perf_counter()
+    deadline = start + duration
+    await asyncio.gather(*(
+        _client(port, request, deadline, latencies, statuses)
+        for _ in range(concurrency)))
+    return latencies, statuses, time.perf_counter() - start
+
+
+def run(
+        quick: bool = False,
+        port: int = DEFAULT_PORT,
+        workers: int = 1,
+        database: Optional[Dict[str, Any]] = None) -> List[Result]:
+    levels = CONCURRENCY[:2] if quick else CONCURRENCY
+    duration = 2.0 if quick else DURATION
+    frame = encode_jpeg(synthetic_frame(640, 480, 1))
+
+    results = []
+    with tempfile.TemporaryDirectory() as model_dir:
+        sections = {"database": {"postgres": database}} if database else {}
+        # Every request sends the same frame, which would otherwise only be
+        # searched for faces once.
+        sections["result_cache"] = {"size": 0}
+        config = benchmark_config(model_dir, **sections)
+        train_synthetic_model(config, PEOPLE, 2 if quick else PER_PERSON)
+
+        process = multiprocessing.get_context("spawn").Process(
+            target=_serve, args=(config._config, port, workers))
+        process.start()
+        try:
+            _wait_for_server(port, process)
+            # The pool size is only reported while connected.
+            connected = "\ncornea_db_pool_size " in _get(port, "/metrics")
+
+            for concurrency in levels:
+                latencies, statuses, elapsed = asyncio.run(
+                    _load(port, frame, concurrency, duration))
+                results.append({
+                    "concurrency": concurrency,
+                    "server_workers": workers,
+                    "database": connected,
+                    "frame_bytes": len(frame),
+                    "duration_s": elapsed,
+                    "requests_per_second": len(latencies) / elapsed,
+                    "statuses": {str(k): v for k, v in statuses.items()},
+                    "latency": summarise(latencies) if latencies else None
+                })
+        finally:
+            process.terminate()
+            process.join()
+
+    return results
+
+
+def main() -> None:
+    parser = create_argument_parser(__doc__)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument(
+        "--workers", type=int, default=1, help="Server worker processes")
+    parser.add_argument("--database-host")
+    parser.add_argument("--database-port", type=int)
+    parser.add_argument("--database-name")
+    parser.add_argument("--database-user")
+    parser.add_argument("--database-password")
+    args = parser.parse_args()
+
+    database = None
+    options = (args.database_host, args.database_port, args.database_name,
+               args.database_user, args.database_password)
+    if any(option is not None for option in options):
+        database = {
+            "host": args.database_host or HOST,
+            "port": args.database_port or DEFAULT_DATABASE_PORT,
+            "database": args.database_name or DEFAULT_DATABASE_NAME,
+            "user": args.database_user or DEFAULT_DATABASE_USER,
+            "password": args.database_password
+        }
+    report({"detect_frame": run(args.quick, args.port, args.workers,
+                                database)}, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+Benchmark how long each command of the CLI takes to start, timing fresh
+interpreters which import the modules the command needs before it does any
+work, and check the times against a budget for each command. Exits with a
+status of 1 if any command is over its budget.
+"""
+import sys
+import time
+import subprocess
+from typing import List, Sequence
+
+from benchmarks.common import (
+    Result, create_argument_parser, report, summarise)
+
+# The modules each command imports before doing any work, and the most
+# milliseconds importing them may take on top of starting the interpreter.
+COMMANDS = {
+    "add_person": (["cornea.__main__", "cornea.database"], 250),
+    "ingest": (["cornea.__main__", "cornea.database", "cornea.training"], 600),
+    "train": (["cornea.__main__", "cornea.database", "cornea.training"], 600),
+    "run": (["cornea.__main__", "cornea.server"], 1000),
+}
+# --help only parses its arguments, so it is timed by running it.
+HELP_BUDGET_MS = 250
+
+# Modules which are slow to import, listed for each command which loads them.
+HEAVY_MODULES = ["cv2", "numpy", "PIL", "sanic"]
+
+
+def _time(arguments: Sequence[str], repeat: int) -> List[float]:
+    """Time repeat runs of a fresh interpreter with the given arguments."""
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, *arguments],
+                       stdout=subprocess.DEVNULL, check=True)
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def _heavy_modules(modules: Sequence[str]) -> List[str]:
+    """Find which of HEAVY_MODULES importing the modules loads."""
+    output = subprocess.run(
+        [sys.executable, "-c",
+         f"import sys, {', '.join(modules)}\n"
+         f"print(' '.join(m for m in {HEAVY_MODULES!r} "
+         f"if m in sys.modules))"],
+        capture_output=True, text=True, check=True).stdout
+    return output.split()
+
+
+def _result(
+        command: str,
+        durations: List[float],
+        baseline_ms: float,
+        budget_ms: float) -> Result:
+    startup = summarise(durations)
+    import_ms = startup["p50_ms"] - baseline_ms
+    return {
+        "command": command,
+        "startup": startup,
+        "import_ms": import_ms,
+        "budget_ms": budget_ms,
+        "within_budget": import_ms <= budget_ms
+    }
+
+
+def run(quick: bool = False) -> List[Result]:
+    repeat = 3 if quick else 10
+    baseline_ms = summarise(_time(["-c", "pass"], repeat))["p50_ms"]
+
+    results = [_result("help", _time(["-m", "cornea", "--help"], repeat),
+                       baseline_ms, HELP_BUDGET_MS)]
+    results[0]["heavy_modules"] = _heavy_modules(["cornea.__main__"])
+
+    for command, (modules, budget_ms) in COMMANDS.items():
+        durations = _time(["-c", f"import {', '.join(modules)}"], repeat)
+        result = _result(command, durations, baseline_ms, budget_ms)
+        result["heavy_modules"] = _heavy_modules(modules)
+        results.append(result)
+
+    return results
+
+
+def main() -> None:
+    args = create_argument_parser(__doc__).parse_args()
+    results = run(args.quick)
+    report({"startup": results}, args.output)
+    if not all(result["within_budget"] for result in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
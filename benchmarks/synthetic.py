@@ -0,0 +1,104 @@
+"""
+Synthetic face images which OpenCV's Haar cascade detects as faces. Each
+identity has its own proportions, so that a model trained on them can tell
+identities apart, and each image of an identity has its own noise.
+"""
+import math
+from typing import List, Tuple
+
+import cv2
+import numpy as np
+from numpy.typing import NDArray
+
+from cornea.model import FACE_SIZE, normalise_face
+
+BACKGROUND = 60
+
+
+def synthetic_face(
+        size: int,
+        identity: int = 0,
+        seed: int = 0) -> NDArray[np.uint8]:
+    """Draw a size x size grayscale face of an identity."""
+    shape = np.random.default_rng(identity)
+    eye_spacing = shape.uniform(0.11, 0.15)
+    eye_height = shape.uniform(0.06, 0.10)
+    mouth_width = shape.uniform(0.09, 0.14)
+    face_width = shape.uniform(0.30, 0.34)
+    skin = int(shape.integers(180, 220))
+
+    image = np.full((size, size), BACKGROUND, np.uint8)
+    c = size // 2
+    cv2.ellipse(image, (c, c), (int(size * face_width), int(size * 0.42)),
+                0, 0, 360, skin, -1)
+
+    ey, ex = int(c - size * eye_height), int(size * eye_spacing)
+    for side in (-1, 1):
+        x = c + side * ex
+        cv2.ellipse(image, (x, ey), (int(size * 0.07), int(size * 0.035)),
+                    0, 0, 360, 40, -1)
+        cv2.line(image, (x - int(size * 0.08), ey - int(size * 0.08)),
+                 (x + int(size * 0.08), ey - int(size * 0.08)),
+                 50, max(2, size // 40))
+    cv2.line(image, (c, ey + int(size * 0.04)), (c, c + int(size * 0.1)),
+             150, max(2, size // 60))
+    cv2.ellipse(image, (c, c + int(size * 0.2)),
+                (int(size * mouth_width), int(size * 0.04)),
+                0, 0, 360, 70, -1)
+
+    image = cv2.GaussianBlur(image, (0, 0), size / 100)
+    noise = np.random.default_rng(seed).normal(0, 6, image.shape)
+    return np.clip(image + noise, 0, 255).astype(np.uint8)
+
+
+def synthetic_frame(
+        width: int,
+        height: int,
+        faces: int,
+        seed: int = 0) -> NDArray[np.uint8]:
+    """
+    Draw a width x height grayscale frame holding a number of faces laid out
+    in a grid, each of a different identity.
+    """
+    rng = np.random.default_rng(seed)
+    frame = rng.normal(BACKGROUND, 8, (height, width))
+    frame = np.clip(frame, 0, 255).astype(np.uint8)
+    if not faces:
+        return frame
+
+    columns = math.ceil(math.sqrt(faces * width / height))
+    rows = math.ceil(faces / columns)
+    cell_width, cell_height = width // columns, height // rows
+    size = int(min(cell_width, cell_height) * 0.8)
+
+    for i in range(faces):
+        row, column = divmod(i, columns)
+        x = column * cell_width + (cell_width - size) // 2
+        y = row * cell_height + (cell_height - size) // 2
+        frame[y:y + size, x:x + size] = synthetic_face(size, i, seed + i)
+
+    return frame
+
+
+def encode_jpeg(image: NDArray[np.uint8]) -> bytes:
+    return cv2.imencode(".jpg", image)[1].tobytes()
+
+
+def synthetic_crops(
+        people: int,
+        per_person: int,
+        seed: int = 0) -> List[Tuple[bytes, int, int, int]]:
+    """
+    Build face crop records of (crop_data, width, height, tag), as stored in
+    the face_crop table, with per_person crops of each of people identities.
+    Tags start at 1, as person ids do.
+    """
+    width, height = FACE_SIZE
+    records = []
+    for image in range(per_person):
+        for person in range(people):
+            face = synthetic_face(
+                height, person, seed + image * people + person)
+            crop = normalise_face(face)
+            records.append((crop.tobytes(), width, height, person + 1))
+    return records
@@ -0,0 +1,64 @@
+"""
+Benchmark preparing training data and training models on synthetic face
+crops across dataset sizes.
+"""
+import os
+import time
+import tempfile
+from typing import List
+
+from cornea.model import Model
+from cornea.model_file import MODEL_FILE_EXTENSION
+from benchmarks.common import (
+    Result, create_argument_parser, benchmark_config, measure, report)
+from benchmarks.synthetic import synthetic_crops
+
+# (people, crops per person) of each dataset.
+DATASETS = [(10, 10), (50, 20), (100, 25), (200, 25)]
+
+
+def run(quick: bool = False) -> List[Result]:
+    datasets = DATASETS[:2] if quick else DATASETS
+    repeat = 2 if quick else 5
+
+    results = []
+    with tempfile.TemporaryDirectory() as model_dir:
+        config = benchmark_config(model_dir)
+        # Every run overwrites the same model, large models take up a lot of
+        # disk space.
+        model_path = os.path.join(
+            model_dir, f"benchmark{MODEL_FILE_EXTENSION}")
+
+        for people, per_person in datasets:
+            crops = synthetic_crops(people, per_person)
+            model = Model(None, config, False)
+
+            prepare = measure(
+                lambda: model.prepare_training_data(crops), repeat)
+            train = measure(
+                lambda: model.train(crops, model_path, reload=False),
+                repeat, warmup=0)
+
+            start = time.perf_counter()
+            Model.from_file(model_path, config)
+            load_ms = (time.perf_counter() - start) * 1000
+
+            results.append({
+                "people": people,
+                "samples": len(crops),
+                "prepare_training_data": prepare,
+                "train": train,
+                "model_bytes": os.path.getsize(model_path),
+                "load_ms": load_ms
+            })
+
+    return results
+
+
+def main() -> None:
+    args = create_argument_parser(__doc__).parse_args()
+    report({"training": run(args.quick)}, args.output)
+
+
+if __name__ == "__main__":
+    main()
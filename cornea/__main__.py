@@ -1,13 +1,14 @@
 import logging
 import asyncio
-from typing import Dict, Any, Optional
+from typing import Optional
 import argparse
 
-from cornea import database
-from cornea.model import Model
 from cornea.constants import CONFIG_LOCATION
 from cornea.config import load_config_file, Config
-from cornea.training import ingest_training_data, load_training_folder
+
+# Each command imports what it needs when it runs, so that commands which
+# only touch the database, such as --add-person, do not pay for importing
+# OpenCV, NumPy and the server.
 
 logger = logging.getLogger(__name__)
 
@@ -20,8 +21,14 @@ def create_argument_parser() -> argparse.ArgumentParser:
     )
     parser.add_argument(
         "--run", action="store_true", help="Run Cornea server")
+    parser.add_argument(
+        "--workers", action="store", type=int, default=1,
+        help="With --run, the number of server processes to start")
     parser.add_argument(
         "--train", action="store_true", help="Train a new Cornea model")
+    parser.add_argument(
+        "--incremental", action="store_true",
+        help="With --train, only add faces ingested since the latest model")
     parser.add_argument(
         '--ingest', action="store", nargs='+', type=str,
         help="Ingest training data into Cornea's database")
@@ -49,9 +56,11 @@ def run() -> None:
     asyncio.set_event_loop(loop)
 
     if cmdline_arguments.run:
-        serve_application(config, loop)
+        serve_application(config, cmdline_arguments.workers)
     elif cmdline_arguments.train:
-        loop.run_until_complete(start_and_train_only(config))
+        loop.run_until_complete(start_and_train_only(
+            config, cmdline_arguments.incremental)
+        )
     elif cmdline_arguments.ingest:
         loop.run_until_complete(ingest_only(
             config,
@@ -73,52 +82,39 @@ def setup_logging(debug: bool) -> None:
     logging.basicConfig(level=level)
 
 
-async def database_connect(db_config: Dict[str, Any]) -> database.Connection:
-    db_config = db_config["postgres"]
-    return await database.connect(
-        db_config["user"],
-        db_config["password"],
-        db_config["database"],
-        db_config["host"],
-        db_config["port"],
-        asyncio.get_running_loop()
-    )
-
-
-def serve_application(config: Config, loop: asyncio.AbstractEventLoop) -> None:
+def serve_application(config: Config, workers: int = 1) -> None:
     from cornea import server
+    from cornea.model import Model
+    from cornea.watcher import DEFAULT_INTERVAL
 
+    # The model is loaded before the workers are forked so that they share
+    # it. Model files are memory mapped, so models loaded later by each
+    # worker share the same pages of memory too.
     app = server.create_server(Model("data/new_model.yml", config), config)
-    server_coro = app.create_server(
-        return_asyncio_server=True
-    )
 
-    logger.info(f"Starting Cornea server on http://127.0.0.1:8000")
-    app.ctx.conn = loop.run_until_complete(
-        database_connect(config.database)
-    )
-
-    task = asyncio.ensure_future(server_coro, loop=loop)
-    srv = loop.run_until_complete(task)
+    interval = config.model_watcher.get("interval", DEFAULT_INTERVAL)
+    if workers > 1 and not interval:
+        logger.warning(
+            "The model watcher is disabled, so only the worker which runs a "
+            "training job will serve the new model.")
 
-    loop.run_until_complete(srv.startup())
-    loop.run_until_complete(srv.after_start())
-
-    try:
-        loop.run_forever()
-    except KeyboardInterrupt:
-        srv.close()
-        loop.close()
+    logger.info(f"Starting Cornea server on http://127.0.0.1:8000 "
+                f"with {workers} worker(s)")
+    app.run(host="127.0.0.1", port=8000, workers=workers)
 
 
 async def start_and_train_only(
         config: Config,
+        incremental: bool = False
     ) -> None:
+    from cornea import database
+    from cornea.model import Model
+    from cornea.training import train_model
+
     model = Model.load_model(None, config, False)
     
-    conn = await database_connect(config.database)
-    training_data = await database.all_faces(conn)
-    model.train(training_data)
+    pool = await database.connect_from_config(config.database)
+    await train_model(pool, model, incremental=incremental)
 
 
 async def ingest_only(
@@ -128,9 +124,13 @@ async def ingest_only(
 ) -> None:
     if tag is None:
         raise ValueError("Must provide a tag for training folder.")
-    conn = await database_connect(config.database)
-    td = load_training_folder(ingest_folder, tag)
-    await ingest_training_data(conn, td)
+    from cornea import database
+    from cornea.model import Model
+    from cornea.training import ingest_training_folder
+
+    pool = await database.connect_from_config(config.database)
+    model = Model.load_model(None, config, False)
+    await ingest_training_folder(pool, ingest_folder, tag, model)
 
 
 async def do_add_person(
@@ -139,10 +139,12 @@ async def do_add_person(
 ) -> None:
     if name is None:
         raise ValueError("Must provide a name for the person")
-    conn = await database_connect(config.database)
+    from cornea import database
+
+    pool = await database.connect_from_config(config.database)
 
     logger.info(f"Write name: {str(name)}")
-    await database.write_person(conn, name[0], name[1])
+    await database.write_person(pool, name[0], name[1])
 
 
 if __name__ == '__main__':
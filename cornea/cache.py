@@ -0,0 +1,195 @@
+from __future__ import annotations
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Hashable, List, Optional, Tuple
+
+import cv2
+import numpy as np
+from numpy.typing import NDArray
+
+from cornea.frame import Frame
+from cornea.model import Model, Match
+from cornea.detection import Region
+from cornea.config import Config
+from cornea.metrics import STAGE_SECONDS, RESULT_CACHE_LOOKUPS
+
+DEFAULT_SIZE = 256
+DEFAULT_TTL = 10.0
+DEFAULT_MAX_DIFFERENCE = 2.0
+
+# Frames are decoded at 1/THUMBNAIL_REDUCTION of their size and shrunk to a
+# THUMBNAIL_SIZE x THUMBNAIL_SIZE thumbnail to be compared.
+THUMBNAIL_REDUCTION = 8
+THUMBNAIL_SIZE = 16
+
+# Outcomes of looking up a frame, as counted in RESULT_CACHE_LOOKUPS.
+HIT = "hit"
+NEAR_HIT = "near_hit"
+MISS = "miss"
+
+# The model which found a result, when the result expires and the result.
+_Entry = Tuple[Model, float, List[Match]]
+# The size of a frame, its region, its thumbnail and its result.
+_Similar = Tuple[Tuple[int, ...], Optional[Region], NDArray[np.int16], _Entry]
+
+
+def frame_digest(frame: Frame) -> bytes:
+    """Hash the bytes of a frame."""
+    return hashlib.blake2b(frame.frame_data, digest_size=16).digest()
+
+
+def thumbnail(frame: Frame) -> Tuple[Tuple[int, ...], NDArray[np.int16]]:
+    """
+    Shrink a frame to a tiny thumbnail, which is much the same for frames
+    which look alike even if their bytes are quite different, such as frames
+    of a still scene from a camera with a noisy sensor. Returns the size of
+    the decoded frame the thumbnail was made from, and the thumbnail.
+    """
+    image = frame.decode(THUMBNAIL_REDUCTION)
+    small = cv2.resize(image, (THUMBNAIL_SIZE, THUMBNAIL_SIZE),
+                       interpolation=cv2.INTER_AREA)
+    return image.shape, small.astype(np.int16)
+
+
+class ResultCache:
+    """
+    Remembers the faces found in recent frames, so that a frame sent again,
+    such as by a camera watching a scene in which nothing moves, is answered
+    without being decoded or searched for faces.
+
+    Frames are looked up by a hash of their bytes. If perceptual is set,
+    frames which only look almost the same as one already handled, with
+    thumbnails differing by at most max_difference grey levels on average,
+    get its result too. This costs decoding a thumbnail of every frame which
+    is not found and comparing it with those of the cached frames. Up to
+    size results are kept for ttl seconds, or until they are pushed out by
+    newer ones if ttl is 0, and results are only given for the model which
+    found them.
+
+    handle_frame may be called from any thread.
+    """
+    def __init__(
+            self,
+            size: int = DEFAULT_SIZE,
+            ttl: float = DEFAULT_TTL,
+            perceptual: bool = False,
+            max_difference: float = DEFAULT_MAX_DIFFERENCE
+    ) -> None:
+        self.size = size
+        self.ttl = ttl
+        self.perceptual = perceptual
+        self.max_difference = max_difference
+        self._results: OrderedDict[Hashable, _Entry] = OrderedDict()
+        self._similar: OrderedDict[Hashable, _Similar] = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config: Config) -> Optional[ResultCache]:
+        """
+        Create a cache from the result_cache section of the config, or None
+        if its size is 0.
+        """
+        cache = config.result_cache
+        size = cache.get("size", DEFAULT_SIZE)
+        if not size:
+            return None
+
+        return cls(
+            size,
+            ttl=cache.get("ttl", DEFAULT_TTL),
+            perceptual=bool(cache.get("perceptual")),
+            max_difference=cache.get(
+                "max_difference", DEFAULT_MAX_DIFFERENCE)
+        )
+
+    def __len__(self) -> int:
+        return len(self._results)
+
+    def handle_frame(
+            self,
+            model: Model,
+            frame: Frame,
+            region: Optional[Region] = None) -> List[Match]:
+        """
+        Get the result of model.handle_frame for a frame, from the cache if
+        the same frame has been handled recently.
+        """
+        with STAGE_SECONDS.time(stage="hash"):
+            key = (frame.frame_data.shape, region, frame_digest(frame))
+        result = self._get(key, model)
+        if result is not None:
+            RESULT_CACHE_LOOKUPS.inc(result=HIT)
+            return result
+
+        shape, small = None, None
+        if self.perceptual:
+            with STAGE_SECONDS.time(stage="hash"):
+                shape, small = thumbnail(frame)
+            result = self._find_similar(model, shape, region, small)
+            if result is not None:
+                RESULT_CACHE_LOOKUPS.inc(result=NEAR_HIT)
+                return result
+
+        RESULT_CACHE_LOOKUPS.inc(result=MISS)
+        result = model.handle_frame(frame, region)
+
+        entry = (model, time.monotonic() + self.ttl, result)
+        with self._lock:
+            self._put(self._results, key, entry)
+            if small is not None:
+                self._put(self._similar, key, (shape, region, small, entry))
+        return result
+
+    def clear(self) -> None:
+        with self._lock:
+            self._results.clear()
+            self._similar.clear()
+
+    def _is_valid(self, entry: _Entry, model: Model, now: float) -> bool:
+        owner, expires, _ = entry
+        return owner is model and (not self.ttl or expires > now)
+
+    def _get(self, key: Hashable, model: Model) -> Optional[List[Match]]:
+        with self._lock:
+            entry = self._results.get(key)
+            if entry is None:
+                return None
+            if not self._is_valid(entry, model, time.monotonic()):
+                del self._results[key]
+                return None
+
+            self._results.move_to_end(key)
+            return entry[2]
+
+    def _find_similar(
+            self,
+            model: Model,
+            shape: Tuple[int, ...],
+            region: Optional[Region],
+            small: NDArray[np.int16]) -> Optional[List[Match]]:
+        """Find the result of the most recent frame which looks alike."""
+        now = time.monotonic()
+        with self._lock:
+            for key, similar in reversed(self._similar.items()):
+                other_shape, other_region, other_small, entry = similar
+                if other_shape != shape or other_region != region or \
+                        not self._is_valid(entry, model, now):
+                    continue
+                if np.abs(small - other_small).mean() > self.max_difference:
+                    continue
+
+                self._similar.move_to_end(key)
+                return entry[2]
+        return None
+
+    def _put(
+            self,
+            entries: OrderedDict[Hashable, Any],
+            key: Hashable,
+            entry: Any) -> None:
+        entries[key] = entry
+        entries.move_to_end(key)
+        while len(entries) > self.size:
+            entries.popitem(last=False)
@@ -22,6 +22,131 @@ database:
     #     password: "welcome"
     #     host: "127.0.0.1"
     #     port: 5432
+    #     # Size limits of the pool of connections kept to the database.
+    #     # Training reads and writes at the same time, so max_size must be
+    #     # at least 2.
+    #     min_size: 2
+    #     max_size: 10
+
+# Training streams face crops from the database in chunks of prefetch rows,
+# which bounds the memory used while training. Finding faces in ingested
+# images is spread across a number of worker processes, leave workers unset
+# to use one per CPU core.
+training:
+    prefetch: 500
+    # workers: 4
+
+# Ingested images are read from disk by a number of reader threads and
+# written to the database batch_size images at a time.
+ingest:
+    batch_size: 100
+    readers: 8
+
+# Face detection and recognition run in a pool of worker threads so that they
+# do not block the server. Leave workers unset to use one per CPU core.
+# Requests arriving while workers + queue_size frames are already in flight
+# are rejected with a 503 and a Retry-After header of retry_after seconds.
+# Batches sent to /model/detect_frames may hold at most max_batch_size frames,
+# and no more than workers + queue_size, as each frame takes a place in the
+# queue.
+inference:
+    # workers: 4
+    queue_size: 8
+    retry_after: 1
+    max_batch_size: 64
+
+# Faces are searched for in frames using a Haar cascade, with the given scale
+# factor and minimum neighbours. Faces smaller than min_face_size or larger
+# than max_face_size pixels across are ignored, 0 for no limit. Frames wider
+# than detect_width pixels are scaled down to that width to be searched,
+# faces are still recognised from the full frame. JPEG frames can be decoded
+# at 1/2, 1/4 or 1/8 of their size with decode_reduction, in which case faces
+# are also recognised at that size. Regions limits the search of the frames
+# of a stream to an [x, y, w, h] rectangle of the full frame.
+detection:
+    scale_factor: 1.2
+    min_neighbors: 5
+    min_face_size: 0
+    max_face_size: 0
+    # detect_width: 640
+    decode_reduction: 1
+    regions:
+        # camera1: [0, 0, 1280, 720]
+
+# While serving, the model directory is checked for new models every interval
+# seconds. A new model is loaded once it has stopped changing, so models can be
+# copied in from elsewhere. Set interval to 0 to only change models when
+# training finishes or through the API.
+model_watcher:
+    interval: 5
+
+# Faces are recognised by comparing them against every face in the model at
+# once. If candidate_tags is set, faces are only compared against the people
+# whose average face is among the candidate_tags closest, which is faster for
+# large models but no longer exact.
+recognition:
+    candidate_tags: 0
+
+# The faces found in recent frames are cached, so that a frame sent again is
+# answered without searching it, keeping up to size results for ttl seconds.
+# Set size to 0 to turn the cache off. If perceptual is set, frames which
+# look almost the same as a cached one, with tiny thumbnails of them differing
+# by at most max_difference grey levels on average, are given its result too.
+# Frames sent with a stream id are tracked instead.
+result_cache:
+    size: 256
+    ttl: 10
+    perceptual: false
+    max_difference: 2
+
+# Recognised faces are named from a cache of the people in the database,
+# holding up to size people. Set size to 0 to cache everyone.
+person_cache:
+    size: 10000
+
+# Requests to detect_frame can be traced to find out which stage of handling
+# them was slow. When enabled, requests with an X-Cornea-Profile header of
+# "stages" or "cprofile" are traced, as is a sample_rate fraction of all
+# requests. Sampled traces faster than threshold seconds are discarded, and
+# the last traces kept are served at /debug/traces.
+profiling:
+    enabled: false
+    sample_rate: 0.0
+    threshold: 0.5
+    cprofile: false
+    traces: 50
+
+# Frames sent with a stream id are tracked from one frame to the next. Faces
+# are searched for in the whole frame every detect_interval frames, and in
+# between each face is only searched for close to where it was last seen,
+# within margin times its size. The identity of a face is kept until it is
+# lost, except faces recognised with a confidence below min_confidence, which
+# are recognised again in every frame. Streams which send nothing for
+# idle_timeout seconds are forgotten.
+tracking:
+    detect_interval: 10
+    margin: 0.5
+    min_confidence: 0
+    idle_timeout: 30
+
+# The frames of a stream can be passed through a motion gate, which compares
+# each frame with a background image of the stream kept by learning
+# learning_rate of every frame. Frames in which fewer than a threshold
+# fraction of the pixels differ from the background by more than
+# pixel_threshold grey levels are not searched for faces, and are given the
+# faces of the frame before. A frame is searched anyway after max_skipped
+# frames in a row have not been, 0 for never. Settings given for a stream id
+# under streams override these for that stream.
+motion_gate:
+    enabled: false
+    threshold: 0.01
+    pixel_threshold: 15
+    learning_rate: 0.05
+    max_skipped: 100
+    streams:
+        # camera1:
+        #     enabled: true
+        #     threshold: 0.02
 """
 
 
@@ -105,3 +230,18 @@ class Config:
         self.model_dir: str = self._config["model_default_path"]
         self.database: Dict[str, Any] = self._config["database"]
         self.people: List[Dict[str, Any]] = self._config["people"]
+        self.training: Dict[str, Any] = self._config.get("training", {})
+        self.ingest: Dict[str, Any] = self._config.get("ingest", {})
+        self.inference: Dict[str, Any] = self._config.get("inference", {})
+        self.tracking: Dict[str, Any] = self._config.get("tracking", {})
+        self.motion_gate: Dict[str, Any] = self._config.get(
+            "motion_gate", {})
+        self.detection: Dict[str, Any] = self._config.get("detection", {})
+        self.recognition: Dict[str, Any] = self._config.get("recognition", {})
+        self.person_cache: Dict[str, Any] = self._config.get(
+            "person_cache", {})
+        self.profiling: Dict[str, Any] = self._config.get("profiling", {})
+        self.result_cache: Dict[str, Any] = self._config.get(
+            "result_cache", {})
+        self.model_watcher: Dict[str, Any] = self._config.get(
+            "model_watcher", {})
@@ -1,14 +1,41 @@
 import os
 import logging
 import asyncio
-from typing import Optional, List, Tuple
+from contextlib import asynccontextmanager
+from typing import (
+    Optional, List, Tuple, Dict, Any, AsyncIterator, Sequence)
 
 import asyncpg
-from asyncpg import Connection
-from asyncpg.exceptions import PostgresError
+from asyncpg import Connection, Pool
+from asyncpg.exceptions import (
+    PostgresError, PostgresConnectionError, InterfaceError)
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_POOL_MIN_SIZE = 2
+DEFAULT_POOL_MAX_SIZE = 10
+
+# Number of rows fetched from a server-side cursor at a time when streaming
+# large tables.
+DEFAULT_CHUNK_SIZE = 500
+
+# How many times to try to acquire a working connection before giving up,
+# and how long to wait between attempts, doubling each time.
+ACQUIRE_ATTEMPTS = 3
+ACQUIRE_BACKOFF = 0.5
+
+# Errors which mean that a connection has been lost, rather than that a
+# query has failed.
+CONNECTION_ERRORS = (OSError, InterfaceError, PostgresConnectionError)
+
+# Channel notified with the id of each person written, so that servers can
+# keep their cache of people up to date.
+PERSON_CHANNEL = "cornea_person"
+
+# Key of the advisory lock taken while face crops are claimed for training,
+# so that training generations are committed in the order they are given.
+_CLAIM_LOCK_ID = 0x636f726e6561
+
 
 class DatabaseError(Exception):
     """Exception class for generic database errors."""
@@ -26,31 +53,40 @@ class Person:
         self.first_name = first_name
         self.last_name = last_name
 
+    @property
+    def name(self) -> str:
+        return " ".join(
+            part for part in (self.first_name, self.last_name) if part)
+
 
 async def connect(username: Optional[str],
                   password: Optional[str],
                   database: Optional[str],
                   host: Optional[str],
                   port: Optional[int],
-                  loop: asyncio.AbstractEventLoop
-                  ) -> Optional[Connection]:
+                  loop: asyncio.AbstractEventLoop,
+                  min_size: int = DEFAULT_POOL_MIN_SIZE,
+                  max_size: int = DEFAULT_POOL_MAX_SIZE
+                  ) -> Optional[Pool]:
     """
-    Attempt to establish a connection to the PostgreSQL database.
+    Attempt to establish a pool of connections to the PostgreSQL database.
     On connecting to the database, this code will check if all
     database relations have been set up and will set them up if they have not.
     """
     try:
         logger.info("Connecting to PostgreSQL database: "
                     f"postgres://{username}@{host}:{port}/{database}")
-        conn = await asyncpg.connect(
+        pool = await asyncpg.create_pool(
             user=username,
             password=password,
             database=database,
             host=host,
             port=port,
-            loop=loop
+            loop=loop,
+            min_size=min_size,
+            max_size=max_size
         )
-    except PostgresError as e:
+    except (PostgresError, OSError) as e:
         msg = (
             f"An error has occured when connecting to database: {database} "
             f"as {username} located at {host}:{port}. Please ensure that the "
@@ -59,14 +95,69 @@ async def connect(username: Optional[str],
         logger.error(msg)
         return None
     
-    if not await create_tables(conn):
+    if not await create_tables(pool):
+        await pool.close()
         return None
 
     logger.info('Connection successful')
-    return conn
+    return pool
+
+
+async def connect_from_config(
+        db_config: Optional[Dict[str, Any]]) -> Optional[Pool]:
+    """
+    Connect to the database described by the database config section.
+    Returns None if no PostgreSQL database is configured.
+    """
+    db_config = (db_config or {}).get("postgres")
+    if not db_config:
+        logger.info("No PostgreSQL database is configured.")
+        return None
+
+    return await connect(
+        db_config["user"],
+        db_config["password"],
+        db_config["database"],
+        db_config["host"],
+        db_config["port"],
+        asyncio.get_running_loop(),
+        db_config.get("min_size", DEFAULT_POOL_MIN_SIZE),
+        db_config.get("max_size", DEFAULT_POOL_MAX_SIZE)
+    )
 
 
-async def create_tables(conn: Connection) -> bool:
+@asynccontextmanager
+async def acquire(pool: Pool) -> AsyncIterator[Connection]:
+    """
+    Acquire a connection from the pool which has been checked to be alive.
+    Connections lost since they were last used, for example because the
+    database restarted, are discarded and the pool reconnects.
+    """
+    backoff = ACQUIRE_BACKOFF
+    for attempt in range(1, ACQUIRE_ATTEMPTS + 1):
+        conn = await pool.acquire()
+        try:
+            await conn.execute("SELECT 1;")
+        except CONNECTION_ERRORS as e:
+            # Terminating the broken connection makes the pool replace it.
+            conn.terminate()
+            await pool.release(conn)
+            if attempt == ACQUIRE_ATTEMPTS:
+                raise DatabaseError(f"Could not acquire a connection: {e}")
+            logger.warning(f"Database connection lost, reconnecting in "
+                           f"{backoff}s.\n{e}")
+            await asyncio.sleep(backoff)
+            backoff *= 2
+            continue
+
+        try:
+            yield conn
+        finally:
+            await pool.release(conn)
+        return
+
+
+async def create_tables(pool: Pool) -> bool:
     """Create tables in the database needed to run Cornea."""
     logger.info("Creating database tables")
     sql = """
@@ -80,10 +171,25 @@ async def create_tables(conn: Connection) -> bool:
             tag INTEGER REFERENCES person(id),
             face_data BYTEA
         );
+        ALTER TABLE face ADD COLUMN IF NOT EXISTS
+            crops_extracted BOOLEAN NOT NULL DEFAULT FALSE;
+        CREATE TABLE IF NOT EXISTS face_crop(
+            id SERIAL PRIMARY KEY,
+            face_id INTEGER REFERENCES face(id) ON DELETE CASCADE,
+            tag INTEGER REFERENCES person(id),
+            width INTEGER,
+            height INTEGER,
+            crop_data BYTEA
+        );
+        CREATE INDEX IF NOT EXISTS face_crop_face_id_idx
+            ON face_crop(face_id);
+        ALTER TABLE face_crop ADD COLUMN IF NOT EXISTS generation INTEGER;
+        CREATE INDEX IF NOT EXISTS face_crop_generation_idx
+            ON face_crop(generation);
     """
 
     try:
-        async with conn.transaction():
+        async with acquire(pool) as conn, conn.transaction():
             await conn.execute(sql)
     except PostgresError as e:
         logger.error(f"Could not create database tables.\n{e}")
@@ -92,42 +198,52 @@ async def create_tables(conn: Connection) -> bool:
     return True
 
 
-async def write_person(conn: Connection,
+async def write_person(pool: Pool,
                      first_name: str,
-                     last_name: str) -> None:
-    """Write a new person to the database"""
+                     last_name: str) -> Optional[int]:
+    """
+    Write a new person to the database, returning their tag, and notify
+    anyone listening on PERSON_CHANNEL once it is committed.
+    """
     sql = """
         INSERT INTO person (first_name, last_name)
-        VALUES ($1, $2);
+        VALUES ($1, $2) RETURNING id;
     """
     try:
-        async with conn.transaction():
-            await conn.execute(sql, first_name, last_name)
+        async with acquire(pool) as conn, conn.transaction():
+            tag = await conn.fetchval(sql, first_name, last_name)
+            await conn.execute(
+                "SELECT pg_notify($1, $2);", PERSON_CHANNEL, str(tag))
     except PostgresError as e:
         logger.error(
             f'Could not add face {first_name} {last_name} to the database.\n'
             f'Error: {e}'
         )
-        return
+        return None
+
+    return tag
 
 
-def get_person_by_tag_sync(conn: Connection, tag: int) -> Optional[Person]:
+def get_person_by_tag_sync(pool: Pool, tag: int) -> Optional[Person]:
     """Synchronous option to fetch a person from the database."""
-    return asyncio.run(get_faces_by_tag, conn, tag)
+    return asyncio.run(get_person_by_tag(pool, tag))
 
 
-async def get_person_by_tag(conn: Connection, tag: int) -> Optional[Person]:
+async def get_person_by_tag(pool: Pool, tag: int) -> Optional[Person]:
     """Get a person by their training tag from the database."""
     sql = "SELECT * from person WHERE id=$1;"
 
     try:
-        async with conn.transaction():
+        async with acquire(pool) as conn, conn.transaction():
             row = await conn.fetchrow(sql, tag)
     except PostgresError as e:
         logger.error(f"Could not retreive tag: {tag} from database.\n"
                      f"Error: {e}"
         )
         return None
+
+    if row is None:
+        return None
     
     person = Person(
         tag=row["id"],
@@ -138,24 +254,133 @@ async def get_person_by_tag(conn: Connection, tag: int) -> Optional[Person]:
     return person
 
 
+async def get_people(
+        pool: Pool,
+        limit: Optional[int] = None) -> List[Person]:
+    """Get the people in the database, the most recently added first."""
+    sql = "SELECT * from person ORDER BY id DESC LIMIT $1;"
+
+    try:
+        async with acquire(pool) as conn:
+            rows = await conn.fetch(sql, limit)
+    except PostgresError as e:
+        logger.error(f"Error while loading people:\n{e}")
+        raise DatabaseError
+
+    return [
+        Person(
+            tag=row["id"],
+            first_name=row["first_name"],
+            last_name=row["last_name"]
+        )
+        for row in rows
+    ]
+
+
 async def _write_face(
-    conn: Connection,
+    pool: Pool,
     tag: int,
-    blob: bytes
+    blob: bytes,
+    crops: Optional[List[Tuple[bytes, int, int]]] = None
 ) -> bool:
-    """Write a face sample to the database"""
-    sql = """INSERT INTO face (tag, face_data) VALUES ($1, $2);"""
+    """
+    Write a face sample to the database. If the face crops of the sample
+    have already been extracted as (crop_data, width, height) they are
+    written along with it.
+    """
+    sql = """
+        INSERT INTO face (tag, face_data, crops_extracted)
+        VALUES ($1, $2, $3) RETURNING id;
+    """
     try:
-        async with conn.transaction():
-            await conn.execute(sql, tag, blob)
+        async with acquire(pool) as conn, conn.transaction():
+            face_id = await conn.fetchval(sql, tag, blob, crops is not None)
+            if crops is not None:
+                await _insert_face_crops(conn, face_id, tag, crops)
     except PostgresError as e:
         logger.error(e)
         return False
     return True
 
 
+async def write_face_crops(
+    pool: Pool,
+    face_id: int,
+    tag: int,
+    crops: List[Tuple[bytes, int, int]]
+) -> None:
+    """
+    Write the face crops extracted from a face sample, given as
+    (crop_data, width, height), and mark the sample as extracted.
+    """
+    async with acquire(pool) as conn, conn.transaction():
+        await _insert_face_crops(conn, face_id, tag, crops)
+
+
+async def _insert_face_crops(
+    conn: Connection,
+    face_id: int,
+    tag: int,
+    crops: List[Tuple[bytes, int, int]]
+) -> None:
+    crop_sql = """
+        INSERT INTO face_crop (face_id, tag, width, height, crop_data)
+        VALUES ($1, $2, $3, $4, $5);
+    """
+    face_sql = "UPDATE face SET crops_extracted = TRUE WHERE id=$1;"
+
+    await conn.executemany(crop_sql, [
+        (face_id, tag, width, height, crop_data)
+        for crop_data, width, height in crops
+    ])
+    await conn.execute(face_sql, face_id)
+
+
+async def copy_faces(
+    conn: Connection,
+    faces: List[Tuple[int, bytes, List[Tuple[bytes, int, int]]]]
+) -> None:
+    """
+    Bulk write face samples, given as (tag, face_data, crops), along with
+    their extracted face crops using COPY. This should be called inside a
+    transaction so that a failed ingest leaves nothing behind.
+    """
+    if not faces:
+        return
+
+    # COPY cannot return the ids it generates, so reserve them up front in
+    # order to link each crop to its face.
+    id_sql = """
+        SELECT nextval(pg_get_serial_sequence('face', 'id'))
+        FROM generate_series(1, $1);
+    """
+
+    try:
+        face_ids = [row[0] for row in await conn.fetch(id_sql, len(faces))]
+        await conn.copy_records_to_table(
+            "face",
+            records=[
+                (face_id, tag, face_data, True)
+                for face_id, (tag, face_data, _) in zip(face_ids, faces)
+            ],
+            columns=("id", "tag", "face_data", "crops_extracted")
+        )
+        await conn.copy_records_to_table(
+            "face_crop",
+            records=[
+                (face_id, tag, width, height, crop_data)
+                for face_id, (tag, _, crops) in zip(face_ids, faces)
+                for crop_data, width, height in crops
+            ],
+            columns=("face_id", "tag", "width", "height", "crop_data")
+        )
+    except PostgresError as e:
+        logger.error(f"Error while writing faces:\n{e}")
+        raise DatabaseError
+
+
 async def write_face_data_from_image(
-        conn: Connection,
+        pool: Pool,
         tag: int,
         fp: str) -> None:
     if not os.path.exists((path := os.path.abspath(fp))):
@@ -164,19 +389,30 @@ async def write_face_data_from_image(
     with open(path, 'rb') as image:
         image_data = image.read()
     
-    if not await _write_face(conn, tag, image_data):
+    if not await _write_face(pool, tag, image_data):
         raise DatabaseError(
             f"Could not write face beloging to tag: {tag} to the database."
         )
 
 
-async def all_faces(conn: Connection) -> List[Tuple[bytes, int]]:
-    """Get all faces and their training tags from the database."""
-    query = "SELECT * FROM face;"
+async def all_faces(
+        pool: Pool,
+        after: int = 0,
+        until: Optional[int] = None) -> List[Tuple[bytes, int]]:
+    """
+    Get all faces and their training tags from the database, in the order
+    they were added. Only faces with an id greater than after and, if given,
+    no greater than until are returned.
+    """
+    query = """
+        SELECT face_data, tag FROM face
+        WHERE id > $1 AND ($2::INTEGER IS NULL OR id <= $2)
+        ORDER BY id;
+    """
 
     try:
-        async with conn.transaction():
-            rows = await conn.fetch(query)
+        async with acquire(pool) as conn, conn.transaction():
+            rows = await conn.fetch(query, after, until)
     except PostgresError as e:
         logger.error(f"Error while loading all faces:\n{e}")
         raise DatabaseError
@@ -188,14 +424,129 @@ async def all_faces(conn: Connection) -> List[Tuple[bytes, int]]:
     return faces
 
 
+async def _iter_query(
+        pool: Pool,
+        query: str,
+        args: Sequence[Any],
+        chunk_size: int) -> AsyncIterator[List[asyncpg.Record]]:
+    """
+    Run a query through a server-side cursor and yield its rows in chunks of
+    at most chunk_size, so that only one chunk is held in memory at a time.
+    """
+    async with acquire(pool) as conn, conn.transaction():
+        cursor = await conn.cursor(query, *args)
+        while rows := await cursor.fetch(chunk_size):
+            yield rows
+
+
+async def iter_faces_without_crops(
+        pool: Pool,
+        chunk_size: int = DEFAULT_CHUNK_SIZE
+) -> AsyncIterator[List[Tuple[int, bytes, int]]]:
+    """
+    Stream the (id, face_data, tag) of every face whose crops have not been
+    extracted yet, such as faces ingested by an older version of Cornea.
+    """
+    query = """
+        SELECT id, face_data, tag FROM face
+        WHERE NOT crops_extracted
+        ORDER BY id;
+    """
+
+    try:
+        async for rows in _iter_query(pool, query, (), chunk_size):
+            yield [(row["id"], row["face_data"], row["tag"]) for row in rows]
+    except PostgresError as e:
+        logger.error(f"Error while loading faces without crops:\n{e}")
+        raise DatabaseError
+
+
+async def iter_face_crops(
+        pool: Pool,
+        after: int = 0,
+        until: Optional[int] = None,
+        chunk_size: int = DEFAULT_CHUNK_SIZE
+) -> AsyncIterator[List[Tuple[bytes, int, int, int]]]:
+    """
+    Stream the (crop_data, width, height, tag) of the face crops claimed by
+    a training generation greater than after and, if given, no greater than
+    until, in the order the faces were added.
+    """
+    query = """
+        SELECT crop_data, width, height, tag FROM face_crop
+        WHERE generation > $1 AND ($2::INTEGER IS NULL OR generation <= $2)
+        ORDER BY face_id, id;
+    """
+
+    try:
+        async for rows in _iter_query(
+                pool, query, (after, until), chunk_size):
+            yield [(row["crop_data"], row["width"], row["height"], row["tag"])
+                   for row in rows]
+    except PostgresError as e:
+        logger.error(f"Error while loading face crops:\n{e}")
+        raise DatabaseError
+
+
+async def count_face_crops(
+        pool: Pool,
+        after: int = 0,
+        until: Optional[int] = None) -> int:
+    """Count the face crops that iter_face_crops would return."""
+    query = """
+        SELECT COUNT(*) FROM face_crop
+        WHERE generation > $1 AND ($2::INTEGER IS NULL OR generation <= $2);
+    """
+
+    try:
+        async with acquire(pool) as conn:
+            return await conn.fetchval(query, after, until)
+    except PostgresError as e:
+        logger.error(f"Error while counting face crops:\n{e}")
+        raise DatabaseError
+
+
+async def claim_face_crops(pool: Pool) -> int:
+    """
+    Claim every committed face crop which has not been claimed yet for a new
+    training generation, returning the latest generation, or 0 if no crops
+    have been claimed at all.
+
+    Concurrent ingests can commit out of order, so the highest face id does
+    not mark which faces a model holds. Generations are handed out under a
+    lock in the order they are committed, so a model trained on the crops up
+    to a generation holds every crop claimed so far. Crops committed later
+    are left for the next generation.
+    """
+    generation_sql = "SELECT COALESCE(MAX(generation), 0) FROM face_crop;"
+    claim_sql = """
+        UPDATE face_crop SET generation = $1 WHERE generation IS NULL;
+    """
+
+    try:
+        async with acquire(pool) as conn, conn.transaction():
+            await conn.execute(
+                "SELECT pg_advisory_xact_lock($1);", _CLAIM_LOCK_ID)
+            generation = await conn.fetchval(generation_sql)
+            status = await conn.execute(claim_sql, generation + 1)
+    except PostgresError as e:
+        logger.error(f"Error while claiming face crops:\n{e}")
+        raise DatabaseError
+
+    # The status of an UPDATE is "UPDATE <rows>".
+    if int(status.split()[-1]):
+        generation += 1
+    return generation
+
+
 async def get_faces_by_tag(
-        conn: Connection,
+        pool: Pool,
         tag: int) -> List[Tuple[int, int, bytes]]:
     """Get a group of faces by their training tag"""
     query = "SELECT * from face WHERE tag=$1;"
 
     try:
-        async with conn.transaction():
+        async with acquire(pool) as conn, conn.transaction():
             rows = await conn.fetch(query, tag)
     except PostgresError as e:
         logger.error(f"Error while fetching faces for tag: {tag}")
@@ -203,19 +554,19 @@ async def get_faces_by_tag(
     
     faces = []
     for row in rows:
-        face = (row["id", row["tag"], row["face_data"]])
+        face = (row["id"], row["tag"], row["face_data"])
         faces.append(face)
     return faces
 
 
 async def get_face_by_id(
-        conn: Connection,
+        pool: Pool,
         face_id: int) -> Tuple[int, int, bytes]:
     """Get a face by its database primary key"""
     query = "SELECT * from face WHERE id=$1;"
 
     try:
-        async with conn.transaction():
+        async with acquire(pool) as conn, conn.transaction():
             row = await conn.fetchrow(query, face_id)
     except PostgresError as e:
         logger.error(f"Error while fetching face for id: {face_id}")
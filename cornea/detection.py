@@ -0,0 +1,146 @@
+from __future__ import annotations
+import logging
+from typing import Any, Dict, Optional, Tuple
+
+import cv2
+from cv2 import CascadeClassifier
+import numpy as np
+from numpy.typing import NDArray
+
+from cornea.frame import REDUCED_DECODE_FLAGS
+from cornea.config import Config
+
+logger = logging.getLogger(__name__)
+
+# An (x, y, w, h) rectangle of a frame.
+Region = Tuple[int, int, int, int]
+
+DEFAULT_SCALE_FACTOR = 1.2
+DEFAULT_MIN_NEIGHBORS = 5
+
+
+def clip_region(region: Region, width: int, height: int) -> Region:
+    """
+    Clip an (x, y, w, h) region to an image of the given size. The region
+    is empty if it lies outside the image.
+    """
+    x, y, w, h = region
+    left, top = max(0, x), max(0, y)
+    right, bottom = min(width, x + w), min(height, y + h)
+    return left, top, max(0, right - left), max(0, bottom - top)
+
+
+def _as_size(side: int) -> Tuple[int, int]:
+    return (int(side), int(side))
+
+
+class FaceDetector:
+    """
+    Finds the faces in decoded frames with a Haar cascade.
+
+    To keep the cost of detection down on large frames, the search can be
+    limited to a region of the frame and to faces within a range of sizes,
+    and frames wider than detect_width are scaled down before being
+    searched. The boxes found are always given in the coordinates of the
+    image searched so that faces can be recognised from the full image.
+
+    Frames can also be decoded at a reduced size, in which case both
+    detection and recognition work on the reduced image.
+    """
+    def __init__(
+            self,
+            scale_factor: float = DEFAULT_SCALE_FACTOR,
+            min_neighbors: int = DEFAULT_MIN_NEIGHBORS,
+            min_face_size: int = 0,
+            max_face_size: int = 0,
+            detect_width: int = 0,
+            decode_reduction: int = 1,
+            regions: Optional[Dict[str, Region]] = None
+    ) -> None:
+        if decode_reduction not in REDUCED_DECODE_FLAGS:
+            raise ValueError(
+                f"decode_reduction must be one of "
+                f"{', '.join(map(str, REDUCED_DECODE_FLAGS))}.")
+
+        self.scale_factor = scale_factor
+        self.min_neighbors = min_neighbors
+        self.min_face_size = min_face_size
+        self.max_face_size = max_face_size
+        self.detect_width = detect_width
+        self.decode_reduction = decode_reduction
+        self.regions: Dict[str, Region] = {
+            stream_id: tuple(region)
+            for stream_id, region in (regions or {}).items()
+        }
+
+    @classmethod
+    def from_config(cls, config: Config) -> FaceDetector:
+        """Create a detector from the detection section of the config."""
+        detection: Dict[str, Any] = config.detection
+        return cls(
+            scale_factor=detection.get("scale_factor", DEFAULT_SCALE_FACTOR),
+            min_neighbors=detection.get(
+                "min_neighbors", DEFAULT_MIN_NEIGHBORS),
+            min_face_size=detection.get("min_face_size") or 0,
+            max_face_size=detection.get("max_face_size") or 0,
+            detect_width=detection.get("detect_width") or 0,
+            decode_reduction=detection.get("decode_reduction") or 1,
+            regions=detection.get("regions")
+        )
+
+    def region_for(self, stream_id: Optional[str]) -> Optional[Region]:
+        """
+        Get the region of interest configured for a stream, in the
+        coordinates of the decoded image.
+        """
+        region = self.regions.get(stream_id) if stream_id else None
+        if region is None or self.decode_reduction == 1:
+            return region
+
+        return tuple(v // self.decode_reduction for v in region)
+
+    def detect(
+            self,
+            classifier: CascadeClassifier,
+            image: NDArray[np.uint8],
+            region: Optional[Region] = None,
+            min_size: int = 0,
+            max_size: int = 0
+    ) -> NDArray[np.int32]:
+        """
+        Find the (x, y, w, h) of the faces in a grayscale image, optionally
+        only within a region of it. Sizes are given in pixels of the image
+        and override the configured face sizes.
+        """
+        offset_x = offset_y = 0
+        if region is not None:
+            x, y, w, h = clip_region(region, image.shape[1], image.shape[0])
+            offset_x, offset_y = x, y
+            image = image[y:y + h, x:x + w]
+            if image.size == 0:
+                return np.empty((0, 4), dtype=np.int32)
+
+        min_size = min_size or self.min_face_size // self.decode_reduction
+        max_size = max_size or self.max_face_size // self.decode_reduction
+
+        scale = 1.0
+        if self.detect_width and image.shape[1] > self.detect_width:
+            scale = self.detect_width / image.shape[1]
+            image = cv2.resize(
+                image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+        faces = classifier.detectMultiScale(
+            image,
+            scaleFactor=self.scale_factor,
+            minNeighbors=self.min_neighbors,
+            minSize=_as_size(min_size * scale),
+            maxSize=_as_size(max_size * scale)
+        )
+        if len(faces) == 0:
+            return np.empty((0, 4), dtype=np.int32)
+
+        if scale != 1.0:
+            faces = np.rint(faces / scale).astype(np.int32)
+        faces[:, 0] += offset_x
+        faces[:, 1] += offset_y
+        return faces
@@ -0,0 +1,122 @@
+from __future__ import annotations
+import os
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Iterable, List, Optional, TypeVar
+
+from cornea.config import Config
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+A = TypeVar("A")
+
+DEFAULT_QUEUE_SIZE = 8
+DEFAULT_RETRY_AFTER = 1
+
+
+class ExecutorSaturated(Exception):
+    """
+    Raised when the inference executor has no capacity left to accept
+    another job.
+    """
+    def __init__(self, retry_after: int) -> None:
+        super().__init__("Inference executor is saturated.")
+        self.retry_after = retry_after
+
+
+class InferenceExecutor:
+    """
+    Bounded pool of worker threads that runs face detection and recognition
+    away from the event loop.
+
+    OpenCV releases the GIL while decoding, detecting and predicting, so
+    throughput scales with the number of workers. At most
+    `workers + queue_size` jobs are accepted at any one time and anything
+    beyond that is rejected with ExecutorSaturated instead of being queued
+    indefinitely.
+    """
+    def __init__(
+            self,
+            workers: Optional[int] = None,
+            queue_size: int = DEFAULT_QUEUE_SIZE,
+            retry_after: int = DEFAULT_RETRY_AFTER
+    ) -> None:
+        self.workers = workers or os.cpu_count() or 1
+        self.queue_size = queue_size
+        self.retry_after = retry_after
+        self._pending = 0
+        self._pool = ThreadPoolExecutor(
+            max_workers=self.workers,
+            thread_name_prefix="cornea-inference"
+        )
+
+        logger.info(f"Started inference executor with {self.workers} "
+                    f"workers and a queue of {self.queue_size}")
+
+    @classmethod
+    def from_config(cls, config: Config) -> InferenceExecutor:
+        """Create an executor from the inference section of the config."""
+        inference = config.inference
+        return cls(
+            workers=inference.get("workers"),
+            queue_size=inference.get("queue_size", DEFAULT_QUEUE_SIZE),
+            retry_after=inference.get("retry_after", DEFAULT_RETRY_AFTER)
+        )
+
+    @property
+    def capacity(self) -> int:
+        """Maximum number of jobs which may be running or queued."""
+        return self.workers + self.queue_size
+
+    @property
+    def pending(self) -> int:
+        """Number of jobs currently running or queued."""
+        return self._pending
+
+    async def run(self, func: Callable[..., T], *args: Any) -> T:
+        """
+        Run a function in the worker pool and wait for its result.
+        Raises ExecutorSaturated if the pool is full.
+        """
+        if self._pending >= self.capacity:
+            raise ExecutorSaturated(self.retry_after)
+
+        loop = asyncio.get_running_loop()
+        self._pending += 1
+        future = self._pool.submit(func, *args)
+        # Only release the slot once the worker has actually finished, even
+        # if the awaiting request has gone away in the meantime.
+        future.add_done_callback(
+            lambda _: loop.call_soon_threadsafe(self._release))
+
+        return await asyncio.wrap_future(future)
+
+    async def map(self, func: Callable[[A], T], items: Iterable[A]) -> List[T]:
+        """
+        Run a function over several items in parallel across the worker pool
+        and wait for the results, which are returned in order. Each item
+        takes up a place in the queue until it is finished.
+        Raises ExecutorSaturated if the pool cannot take every item.
+        """
+        items = list(items)
+        if self._pending + len(items) > self.capacity:
+            raise ExecutorSaturated(self.retry_after)
+
+        loop = asyncio.get_running_loop()
+        self._pending += len(items)
+        futures = [self._pool.submit(func, item) for item in items]
+        for future in futures:
+            future.add_done_callback(
+                lambda _: loop.call_soon_threadsafe(self._release))
+
+        return list(await asyncio.gather(
+            *(asyncio.wrap_future(future) for future in futures)))
+
+    def _release(self) -> None:
+        self._pending -= 1
+
+    def shutdown(self) -> None:
+        """Stop accepting jobs and shut down the worker threads."""
+        self._pool.shutdown(wait=False, cancel_futures=True)
@@ -1,23 +1,108 @@
+import struct
 from io import BytesIO
-from typing import Union
+from typing import Iterable, List, Optional, Union
 
+import cv2
 import numpy as np
 from numpy.typing import NDArray
 
-_FRAME_T = Union[NDArray[np.uint8], bytes]
+_FRAME_T = Union[NDArray[np.uint8], bytes, bytearray, memoryview]
+
+# Flags to decode an image to grayscale at 1/n of its size. JPEG frames are
+# decoded at the reduced size directly, skipping most of the decoding work.
+REDUCED_DECODE_FLAGS = {
+    1: cv2.IMREAD_GRAYSCALE,
+    2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+    4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+    8: cv2.IMREAD_REDUCED_GRAYSCALE_8
+}
+
+# Each frame in a batch is prefixed with its length as an unsigned 32-bit
+# big endian integer.
+_LENGTH_PREFIX = struct.Struct(">I")
+
+
+class InvalidFrame(ValueError):
+    """Raised when received frame data cannot be turned into an image."""
+    pass
 
 
 class Frame:
     """
     Class to represent a received frame of image data from the API.
+
+    A frame is either an encoded image, such as a JPEG or PNG, or, if a width
+    and height are given, raw 8-bit grayscale pixels in row-major order.
+    Buffers are wrapped rather than copied.
     """
     def __init__(
             self,
-            frame_data: _FRAME_T
+            frame_data: _FRAME_T,
+            width: Optional[int] = None,
+            height: Optional[int] = None
     ):
         self.frame_data: _FRAME_T = frame_data
-        if isinstance(self.frame_data, bytes):
+        if not isinstance(self.frame_data, np.ndarray):
             # convert the frame data into a numpy array if not already
             # converted.
             self.frame_data = np.frombuffer(self.frame_data, dtype=np.uint8)
-        
\ No newline at end of file
+        if self.frame_data.size == 0:
+            raise InvalidFrame("Frame is empty.")
+
+        self.raw = width is not None and height is not None
+        if self.raw:
+            if width <= 0 or height <= 0 or \
+                    self.frame_data.size != width * height:
+                raise InvalidFrame(
+                    f"Expected {width}x{height} grayscale pixels but "
+                    f"received {self.frame_data.size} bytes.")
+            self.frame_data = self.frame_data.reshape(height, width)
+
+    def decode(self, reduction: int = 1) -> NDArray[np.uint8]:
+        """
+        Get the frame as a grayscale image, reduced to 1/reduction of its
+        size, where reduction is 1, 2, 4 or 8.
+        """
+        if self.raw:
+            if reduction == 1:
+                return self.frame_data
+            return np.ascontiguousarray(
+                self.frame_data[::reduction, ::reduction])
+
+        try:
+            image = cv2.imdecode(
+                self.frame_data, REDUCED_DECODE_FLAGS[reduction])
+        except cv2.error as e:
+            raise InvalidFrame(f"Frame data could not be decoded: {e}")
+        if image is None:
+            raise InvalidFrame("Frame data could not be decoded as an image.")
+        return image
+
+
+def pack_frames(frames: Iterable[bytes]) -> bytes:
+    """Pack several frames into a single length-prefixed buffer."""
+    return b"".join(_LENGTH_PREFIX.pack(len(frame)) + bytes(frame)
+                    for frame in frames)
+
+
+def unpack_frames(
+        data: Union[bytes, bytearray, memoryview]) -> List[memoryview]:
+    """
+    Split a buffer created by pack_frames back into its frames. The frames
+    are views into the buffer rather than copies.
+    """
+    view = memoryview(data)
+    frames = []
+    offset = 0
+    while offset < len(view):
+        if offset + _LENGTH_PREFIX.size > len(view):
+            raise InvalidFrame("Frame batch ends with a truncated length.")
+        (length,) = _LENGTH_PREFIX.unpack_from(view, offset)
+        offset += _LENGTH_PREFIX.size
+
+        if offset + length > len(view):
+            raise InvalidFrame("Frame batch ends with a truncated frame.")
+        frames.append(view[offset:offset + length])
+        offset += length
+
+    return frames
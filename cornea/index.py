@@ -0,0 +1,274 @@
+from __future__ import annotations
+import logging
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from numpy.typing import NDArray
+from cv2.face import LBPHFaceRecognizer
+
+
+logger = logging.getLogger(__name__)
+
+# Number of training histograms compared against a query at a time. Small
+# chunks keep the intermediate arrays in the CPU cache.
+CHUNK_ROWS = 32
+
+# The parameters of LBPHFaceRecognizer_create, which new models are trained
+# with.
+DEFAULT_RADIUS = 1
+DEFAULT_NEIGHBORS = 8
+DEFAULT_GRID_X = 8
+DEFAULT_GRID_Y = 8
+# Faces further than this from every sample are unknown. OpenCV defaults to
+# the largest double, so every face is matched.
+DEFAULT_THRESHOLD = float(np.finfo(np.float64).max)
+
+_FLT_EPSILON = np.finfo(np.float32).eps
+
+
+def lbp_image(
+        image: NDArray[np.uint8],
+        radius: int = DEFAULT_RADIUS,
+        neighbors: int = DEFAULT_NEIGHBORS) -> NDArray[np.int32]:
+    """
+    Compute the extended local binary pattern of every pixel of a grayscale
+    image, excluding a border of radius pixels. This follows OpenCV's
+    implementation, including its single precision interpolation, so that
+    the codes are identical to the ones LBPHFaceRecognizer computes.
+    """
+    src = image.astype(np.float32)
+    rows, cols = src.shape
+    centre = src[radius:rows - radius, radius:cols - radius]
+    codes = np.zeros(centre.shape, dtype=np.int32)
+    one = np.float32(1)
+
+    def shifted(dy: int, dx: int) -> NDArray[np.float32]:
+        return src[radius + dy:rows - radius + dy,
+                   radius + dx:cols - radius + dx]
+
+    for n in range(neighbors):
+        angle = 2.0 * np.pi * n / np.float32(neighbors)
+        x = np.float32(radius * np.cos(angle))
+        y = np.float32(-radius * np.sin(angle))
+        fx, fy = int(np.floor(x)), int(np.floor(y))
+        cx, cy = int(np.ceil(x)), int(np.ceil(y))
+        tx, ty = np.float32(x - fx), np.float32(y - fy)
+
+        # Bilinear interpolation of the value at the neighbour.
+        value = (one - tx) * (one - ty) * shifted(fy, fx) \
+            + tx * (one - ty) * shifted(fy, cx) \
+            + (one - tx) * ty * shifted(cy, fx) \
+            + tx * ty * shifted(cy, cx)
+
+        bit = (value > centre) | (np.abs(value - centre) < _FLT_EPSILON)
+        codes |= bit.astype(np.int32) << n
+
+    return codes
+
+
+def spatial_histogram(
+        codes: NDArray[np.int32],
+        patterns: int,
+        grid_x: int = DEFAULT_GRID_X,
+        grid_y: int = DEFAULT_GRID_Y) -> NDArray[np.float32]:
+    """
+    Split an image of LBP codes into a grid of cells and concatenate the
+    normalised histogram of codes in each cell, as LBPHFaceRecognizer does.
+    """
+    height, width = codes.shape[0] // grid_y, codes.shape[1] // grid_x
+    cells = codes[:grid_y * height, :grid_x * width] \
+        .reshape(grid_y, height, grid_x, width) \
+        .transpose(0, 2, 1, 3) \
+        .reshape(grid_y * grid_x, height * width)
+
+    # Offset the codes of each cell so that a single bincount gives the
+    # histogram of every cell.
+    offsets = np.arange(grid_y * grid_x, dtype=np.int32)[:, None] * patterns
+    counts = np.bincount(
+        (cells + offsets).ravel(), minlength=grid_y * grid_x * patterns)
+
+    return counts.astype(np.float32) * np.float32(1.0 / (height * width))
+
+
+def face_histogram(
+        face: NDArray[np.uint8],
+        radius: int = DEFAULT_RADIUS,
+        neighbors: int = DEFAULT_NEIGHBORS,
+        grid_x: int = DEFAULT_GRID_X,
+        grid_y: int = DEFAULT_GRID_Y) -> NDArray[np.float32]:
+    """
+    Compute the LBP histogram of a normalised face, the same histogram
+    LBPHFaceRecognizer would store for it.
+    """
+    return spatial_histogram(
+        lbp_image(face, radius, neighbors), 2 ** neighbors, grid_x, grid_y)
+
+
+def chi_square_distances(
+        histograms: NDArray[np.float32],
+        totals: NDArray[np.float64],
+        query: NDArray[np.float32]) -> NDArray[np.float64]:
+    """
+    Compute the alternative chi-square distance, sum(2 * (h - q)^2 / (h + q)),
+    from a query histogram to each row of a matrix of histograms, given the
+    sum of each row.
+
+    As (h - q)^2 / (h + q) = h + q - 4hq / (h + q), the distance is
+    2 * (sum(h) + sum(q) - 4 * sum(hq / (h + q))), and the last sum only
+    needs to be taken over the bins where the query is non-zero, which is
+    far fewer operations than comparing every bin.
+    """
+    nonzero = np.flatnonzero(query)
+    q = query[nonzero]
+    shared = np.empty(len(histograms), dtype=np.float64)
+
+    for start in range(0, len(histograms), CHUNK_ROWS):
+        h = histograms[start:start + CHUNK_ROWS].take(nonzero, axis=1)
+        denominator = h + q
+        h *= q
+        h /= denominator
+        shared[start:start + CHUNK_ROWS] = h.sum(axis=1)
+
+    distances = 2 * (totals + query.sum(dtype=np.float64) - 4 * shared)
+    # Rounding can leave identical histograms a hair below zero apart.
+    return np.maximum(distances, 0, out=distances)
+
+
+class HistogramIndex:
+    """
+    Nearest neighbour search over the histograms of an LBPH model.
+
+    The training histograms are held in a single float32 matrix and a query
+    face is compared against all of them at once, rather than one at a time
+    as LBPHFaceRecognizer.predict does. The results are the same as predict
+    up to floating point rounding.
+
+    If candidate_tags is set, the query is first compared with the mean
+    histogram of each tag and only the samples of the closest
+    candidate_tags tags are searched, which keeps the cost of a prediction
+    flat as more people are enrolled at the expense of exactness.
+    """
+    def __init__(
+            self,
+            histograms: NDArray[np.float32],
+            labels: NDArray[np.int32],
+            radius: int = DEFAULT_RADIUS,
+            neighbors: int = DEFAULT_NEIGHBORS,
+            grid_x: int = DEFAULT_GRID_X,
+            grid_y: int = DEFAULT_GRID_Y,
+            threshold: float = DEFAULT_THRESHOLD,
+            candidate_tags: int = 0,
+            totals: Optional[NDArray[np.float64]] = None
+    ) -> None:
+        # Memory mapped histograms are used in place rather than copied.
+        self.histograms = histograms
+        self.labels = labels.ravel()
+        self.radius = radius
+        self.neighbors = neighbors
+        self.grid_x = grid_x
+        self.grid_y = grid_y
+        self.threshold = threshold
+        self.candidate_tags = candidate_tags
+        if totals is None:
+            totals = self.histograms.sum(axis=1, dtype=np.float64)
+        self.totals = totals
+
+        self.tags: NDArray[np.int32] = np.unique(self.labels)
+        self._tag_rows: Dict[int, NDArray[np.intp]] = {}
+        self._centroids: Optional[NDArray[np.float32]] = None
+        self._centroid_totals: Optional[NDArray[np.float64]] = None
+        if candidate_tags and len(self.tags) > candidate_tags:
+            self._build_centroids()
+
+    @classmethod
+    def from_recognizer(
+            cls,
+            recognizer: LBPHFaceRecognizer,
+            candidate_tags: int = 0) -> HistogramIndex:
+        """Build an index from the histograms of a trained recognizer."""
+        histograms = recognizer.getHistograms()
+        matrix = np.empty(
+            (len(histograms), histograms[0].size if histograms else 0),
+            dtype=np.float32)
+        for row, histogram in enumerate(histograms):
+            matrix[row] = histogram.ravel()
+
+        return cls(
+            matrix,
+            recognizer.getLabels().astype(np.int32),
+            radius=recognizer.getRadius(),
+            neighbors=recognizer.getNeighbors(),
+            grid_x=recognizer.getGridX(),
+            grid_y=recognizer.getGridY(),
+            threshold=recognizer.getThreshold(),
+            candidate_tags=candidate_tags
+        )
+
+    @classmethod
+    def empty(cls) -> HistogramIndex:
+        """Create an index holding no samples, with the default parameters."""
+        dimensions = DEFAULT_GRID_X * DEFAULT_GRID_Y * 2 ** DEFAULT_NEIGHBORS
+        return cls(np.empty((0, dimensions), dtype=np.float32),
+                   np.empty(0, dtype=np.int32))
+
+    def __len__(self) -> int:
+        return len(self.histograms)
+
+    @property
+    def dimensions(self) -> int:
+        """The length of each histogram."""
+        return self.grid_x * self.grid_y * 2 ** self.neighbors
+
+    def _build_centroids(self) -> None:
+        order = np.argsort(self.labels, kind="stable")
+        bounds = np.flatnonzero(np.diff(self.labels[order])) + 1
+        groups: List[NDArray[np.intp]] = np.split(order, bounds)
+
+        self._tag_rows = {int(self.labels[rows[0]]): rows for rows in groups}
+        self._centroids = np.stack(
+            [self.histograms[self._tag_rows[int(tag)]].mean(axis=0)
+             for tag in self.tags]).astype(np.float32)
+        self._centroid_totals = self._centroids.sum(axis=1, dtype=np.float64)
+
+    def histogram(self, face: NDArray[np.uint8]) -> NDArray[np.float32]:
+        """Compute the LBP histogram of a normalised face."""
+        return face_histogram(
+            face, self.radius, self.neighbors, self.grid_x, self.grid_y)
+
+    def _candidate_rows(
+            self, query: NDArray[np.float32]) -> Optional[NDArray[np.intp]]:
+        if self._centroids is None:
+            return None
+
+        distances = chi_square_distances(
+            self._centroids, self._centroid_totals, query)
+        closest = np.argpartition(
+            distances, self.candidate_tags - 1)[:self.candidate_tags]
+        return np.concatenate(
+            [self._tag_rows[int(self.tags[i])] for i in closest])
+
+    def predict(self, face: NDArray[np.uint8]) -> Tuple[int, float]:
+        """
+        Find the tag of the training histogram closest to a face, returning
+        the tag and its distance in the same form as
+        LBPHFaceRecognizer.predict.
+        """
+        if not len(self.histograms):
+            return -1, float(np.finfo(np.float64).max)
+
+        query = self.histogram(face)
+        rows = self._candidate_rows(query)
+        if rows is None:
+            distances = chi_square_distances(
+                self.histograms, self.totals, query)
+        else:
+            distances = chi_square_distances(
+                self.histograms[rows], self.totals[rows], query)
+
+        best = int(np.argmin(distances))
+        distance = float(distances[best])
+        if distance >= self.threshold:
+            return -1, float(np.finfo(np.float64).max)
+
+        label = self.labels[best if rows is None else rows[best]]
+        return int(label), distance
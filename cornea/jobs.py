@@ -0,0 +1,305 @@
+from __future__ import annotations
+import os
+import json
+import fcntl
+import queue
+import asyncio
+import logging
+import multiprocessing
+from uuid import uuid4
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, IO, Optional
+
+from cornea.config import Config
+from cornea.metrics import TRAINING_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# How long the monitor waits on the job's message queue before checking that
+# the training process is still alive.
+POLL_INTERVAL = 1.0
+
+PENDING = "pending"
+RUNNING = "running"
+COMPLETE = "complete"
+FAILED = "failed"
+
+# Jobs are recorded in this directory of the model directory, so that every
+# server process sharing the model directory can report on them.
+JOBS_DIR = ".jobs"
+# Held locked by the process monitoring the running job, and holds its id.
+ACTIVE_JOB_FILE = "active"
+
+
+class JobAlreadyRunning(Exception):
+    """Raised when a training job is requested while another is running."""
+    def __init__(self, job: TrainingJob) -> None:
+        super().__init__(f"Training job {job.id} is already running.")
+        self.job = job
+
+
+class TrainingJob:
+    """
+    Representation of a single background training run and its progress.
+    """
+    def __init__(self, job_id: str, incremental: bool = False) -> None:
+        self.id = job_id
+        self.incremental = incremental
+        self.status = PENDING
+        self.progress: Dict[str, Any] = {}
+        self.model_path: Optional[str] = None
+        self.error: Optional[str] = None
+        self.created = datetime.now()
+        self.finished: Optional[datetime] = None
+
+    @property
+    def done(self) -> bool:
+        return self.status in (COMPLETE, FAILED)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "status": self.status,
+            "incremental": self.incremental,
+            "progress": self.progress,
+            "model": self.model_path,
+            "error": self.error,
+            "created": self.created.isoformat(),
+            "finished": self.finished and self.finished.isoformat()
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> TrainingJob:
+        job = cls(data["id"], data["incremental"])
+        job.status = data["status"]
+        job.progress = data["progress"]
+        job.model_path = data["model"]
+        job.error = data["error"]
+        job.created = datetime.fromisoformat(data["created"])
+        if data["finished"]:
+            job.finished = datetime.fromisoformat(data["finished"])
+        return job
+
+
+def _run_training_job(
+        config_dict: Dict[Any, Any],
+        incremental: bool,
+        messages: multiprocessing.Queue) -> None:
+    """
+    Entry point of the training process. Progress and the final outcome are
+    reported back to the server through the message queue.
+    """
+    logging.basicConfig(level=logging.INFO)
+
+    def report(progress: Dict[str, Any]) -> None:
+        messages.put(("progress", progress))
+
+    try:
+        output_path = asyncio.run(
+            _train(Config(config_dict), incremental, report))
+    except Exception as e:
+        logger.exception("Training job failed")
+        messages.put(("failed", str(e) or type(e).__name__))
+        return
+
+    messages.put(("complete", output_path))
+
+
+async def _train(
+        config: Config,
+        incremental: bool,
+        report: Callable[[Dict[str, Any]], None]) -> str:
+    # These are imported here so the server process does not need to import
+    # the training pipeline just to launch a job.
+    from cornea import database
+    from cornea.model import Model
+    from cornea.training import train_model
+
+    pool = await database.connect_from_config(config.database)
+    if pool is None:
+        raise RuntimeError("Could not connect to the database.")
+
+    try:
+        model = Model.load_model(None, config, False)
+        return await train_model(
+            pool, model, report, reload=False, incremental=incremental)
+    finally:
+        await pool.close()
+
+
+class TrainingManager:
+    """
+    Runs model training in a separate process so that the server can keep
+    serving predictions, and keeps track of the jobs it has started.
+
+    Only one job runs at a time, even when several server processes share
+    the model directory: starting a job takes a lock on a file in the
+    directory which is held until the job finishes. Jobs are written to the
+    directory as they progress so that any of the processes can report on
+    them.
+    """
+    def __init__(
+            self,
+            config: Config,
+            on_complete: Callable[[str], Awaitable[None]]
+    ) -> None:
+        self.config = config
+        self.jobs: Dict[str, TrainingJob] = {}
+        self._on_complete = on_complete
+        self._active: Optional[TrainingJob] = None
+        self._jobs_dir = os.path.join(config.model_dir, JOBS_DIR)
+        # Spawn rather than fork, the server process has an event loop and
+        # worker threads running which must not be copied into the child.
+        self._context = multiprocessing.get_context("spawn")
+
+    def get(self, job_id: str) -> Optional[TrainingJob]:
+        """Get a job started by this or any other server process."""
+        job = self.jobs.get(job_id)
+        if job is not None:
+            return job
+
+        # Ids are hex strings, anything else cannot name a job file.
+        try:
+            int(job_id, 16)
+        except ValueError:
+            return None
+        try:
+            with open(self._job_path(job_id)) as job_file:
+                return TrainingJob.from_dict(json.load(job_file))
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _job_path(self, job_id: str) -> str:
+        return os.path.join(self._jobs_dir, f"{job_id}.json")
+
+    def _save(self, job: TrainingJob) -> None:
+        path = self._job_path(job.id)
+        with open(f"{path}.partial", "w") as job_file:
+            json.dump(job.to_dict(), job_file)
+        os.replace(f"{path}.partial", path)
+
+    def _lock(self) -> IO[str]:
+        """
+        Take the lock held while a job runs, raising JobAlreadyRunning if a
+        job started by any server process is still running.
+        """
+        os.makedirs(self._jobs_dir, exist_ok=True)
+        lock_file = open(os.path.join(self._jobs_dir, ACTIVE_JOB_FILE), "a+")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.seek(0)
+            job_id = lock_file.read().strip()
+            lock_file.close()
+            # The job file may not have been written yet.
+            job = self.get(job_id) or TrainingJob(job_id)
+            job.status = RUNNING
+            raise JobAlreadyRunning(job)
+
+        return lock_file
+
+    def start(self, incremental: bool = False) -> TrainingJob:
+        """
+        Start a new training job in the background and return it. If
+        incremental is set, the latest model is updated with new faces rather
+        than a new model being trained from scratch.
+        Raises JobAlreadyRunning if a job is still in progress.
+        """
+        if self._active is not None and not self._active.done:
+            raise JobAlreadyRunning(self._active)
+
+        lock_file = self._lock()
+        job = TrainingJob(uuid4().hex, incremental)
+        messages = self._context.Queue()
+        process = self._context.Process(
+            target=_run_training_job,
+            args=(self.config._config, incremental, messages),
+            name=f"cornea-train-{job.id}",
+            daemon=True
+        )
+        try:
+            process.start()
+        except Exception:
+            lock_file.close()
+            raise
+        logger.info(f"Started training job {job.id} (pid {process.pid})")
+
+        job.status = RUNNING
+        self.jobs[job.id] = job
+        self._active = job
+        self._save(job)
+        lock_file.truncate(0)
+        lock_file.write(job.id)
+        lock_file.flush()
+        asyncio.ensure_future(self._monitor(job, process, messages, lock_file))
+
+        return job
+
+    async def _monitor(
+            self,
+            job: TrainingJob,
+            process: multiprocessing.Process,
+            messages: multiprocessing.Queue,
+            lock_file: IO[str]
+    ) -> None:
+        """Follow the progress of a job until its process finishes."""
+        try:
+            await self._follow(job, process, messages)
+        finally:
+            # Closing the file releases the lock for the next job.
+            lock_file.close()
+
+    async def _follow(
+            self,
+            job: TrainingJob,
+            process: multiprocessing.Process,
+            messages: multiprocessing.Queue
+    ) -> None:
+        loop = asyncio.get_running_loop()
+
+        while not job.done:
+            try:
+                kind, payload = await loop.run_in_executor(
+                    None, messages.get, True, POLL_INTERVAL)
+            except queue.Empty:
+                if not process.is_alive():
+                    self._finish(job, FAILED, error=(
+                        "Training process exited unexpectedly with code "
+                        f"{process.exitcode}."))
+                continue
+
+            if kind == "progress":
+                job.progress.update(payload)
+                self._save(job)
+            elif kind == "complete":
+                try:
+                    await self._on_complete(payload)
+                except Exception as e:
+                    logger.exception(f"Could not load model: {payload}")
+                    self._finish(job, FAILED, error=str(e))
+                else:
+                    self._finish(job, COMPLETE, model_path=payload)
+            elif kind == "failed":
+                self._finish(job, FAILED, error=payload)
+
+        await loop.run_in_executor(None, process.join)
+
+    def _finish(
+            self,
+            job: TrainingJob,
+            status: str,
+            model_path: Optional[str] = None,
+            error: Optional[str] = None
+    ) -> None:
+        job.status = status
+        job.model_path = model_path
+        job.error = error
+        job.finished = datetime.now()
+        self._save(job)
+        TRAINING_SECONDS.observe(
+            (job.finished - job.created).total_seconds(), status=status)
+
+        if error is None:
+            logger.info(f"Training job {job.id} finished: {model_path}")
+        else:
+            logger.error(f"Training job {job.id} failed: {error}")
@@ -0,0 +1,401 @@
+from __future__ import annotations
+import os
+import json
+import time
+import bisect
+import asyncio
+import logging
+import threading
+from abc import ABC, abstractmethod
+from typing import (
+    Any, Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple,
+    TypeVar)
+
+from cornea.profiling import current_trace
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds, in seconds, of the buckets of latency histograms. Most stages
+# of handling a frame take well under a millisecond to tens of milliseconds.
+LATENCY_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+    0.25, 0.5, 1.0, 2.5
+)
+# Upper bounds, in seconds, of the buckets of long running tasks such as
+# loading and training models.
+DURATION_BUCKETS = (0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, 3600.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# How often, in seconds, each worker of a multi-worker server shares its
+# metrics with the others.
+DEFAULT_SHARE_INTERVAL = 1.0
+
+LabelValues = Tuple[str, ...]
+# The values of a metric for each combination of its labels.
+Values = Dict[LabelValues, Any]
+M = TypeVar("M", bound="Metric")
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(
+        f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return f"{{{pairs}}}"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(ABC):
+    """
+    Base of the metrics Cornea exposes in the Prometheus text format. A
+    metric holds one value, or set of values, for each combination of its
+    labels. Metrics may be updated from any thread.
+    """
+    kind = "untyped"
+
+    def __init__(
+            self,
+            name: str,
+            documentation: str,
+            labelnames: Sequence[str] = ()
+    ) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[LabelValues, Any] = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def remove(self, **labels: str) -> None:
+        """Stop exposing the values of a combination of labels."""
+        with self._lock:
+            self._values.pop(self._key(labels), None)
+
+    def collect(self) -> Values:
+        """Copy the current values of the metric."""
+        with self._lock:
+            return dict(self._values)
+
+    @staticmethod
+    def add(value: Any, other: Any) -> Any:
+        """Add up the values of the metric from two processes."""
+        return value + other
+
+    @abstractmethod
+    def samples(self, values: Values) -> Iterator[Tuple[str, str, float]]:
+        """Yield the (name, labels, value) of every sample of the metric."""
+
+    def render(self, values: Optional[Values] = None) -> List[str]:
+        """Render the metric, or the given values of it."""
+        if values is None:
+            values = self.collect()
+        lines = [f"# HELP {self.name} {self.documentation}",
+                 f"# TYPE {self.name} {self.kind}"]
+        lines.extend(f"{name}{labels} {_format_value(value)}"
+                     for name, labels, value in self.samples(values))
+        return lines
+
+
+class Counter(Metric):
+    """A value which only goes up, such as a number of frames."""
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self, values: Values) -> Iterator[Tuple[str, str, float]]:
+        for key, value in values.items():
+            yield self.name, _format_labels(self.labelnames, key), value
+
+
+class Gauge(Metric):
+    """
+    A value which goes up and down. If a function is given, it is called to
+    get the value whenever the metric is collected, and None means that
+    there is no value to expose.
+    """
+    kind = "gauge"
+
+    def __init__(
+            self,
+            name: str,
+            documentation: str,
+            function: Optional[Callable[[], Optional[float]]] = None
+    ) -> None:
+        super().__init__(name, documentation)
+        self.function = function
+        self._value = 0.0
+
+    def set(self, value: float) -> None:
+        self._value = value
+
+    def collect(self) -> Values:
+        value = self.function() if self.function is not None else self._value
+        return {} if value is None else {(): value}
+
+    def samples(self, values: Values) -> Iterator[Tuple[str, str, float]]:
+        for value in values.values():
+            yield self.name, "", value
+
+
+class Histogram(Metric):
+    """
+    Counts observations, such as how long something took, in buckets by
+    their value.
+    """
+    kind = "histogram"
+
+    def __init__(
+            self,
+            name: str,
+            documentation: str,
+            labelnames: Sequence[str] = (),
+            buckets: Sequence[float] = LATENCY_BUCKETS
+    ) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels: str) -> None:
+        self._observe(self._key(labels), value)
+
+    def _observe(self, key: LabelValues, value: float) -> None:
+        # Each set of labels has the count of each bucket, not including the
+        # buckets below it, then the count above the last bucket and the sum.
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            values = self._values.get(key)
+            if values is None:
+                values = self._values[key] = [0] * (len(self.buckets) + 2)
+            values[index] += 1
+            values[-1] += value
+
+    def time(self, **labels: str) -> Timer:
+        """
+        Time a block of code with a with statement and observe how long it
+        took in seconds.
+        """
+        return Timer(self, self._key(labels))
+
+    def collect(self) -> Values:
+        with self._lock:
+            return {key: list(counts) for key, counts in self._values.items()}
+
+    @staticmethod
+    def add(value: Any, other: Any) -> Any:
+        return [a + b for a, b in zip(value, other)]
+
+    def samples(self, values: Values) -> Iterator[Tuple[str, str, float]]:
+        for key, counts in values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                yield f"{self.name}_bucket", _format_labels(
+                    self.labelnames + ("le",), key + (_format_value(bound),)
+                ), cumulative
+            labels = _format_labels(self.labelnames, key)
+            yield f"{self.name}_sum", labels, counts[-1]
+            yield f"{self.name}_count", labels, cumulative
+
+
+class Timer:
+    __slots__ = ("histogram", "key", "start")
+
+    def __init__(self, histogram: Histogram, key: LabelValues) -> None:
+        self.histogram = histogram
+        self.key = key
+
+    def __enter__(self) -> Timer:
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        elapsed = time.perf_counter() - self.start
+        self.histogram._observe(self.key, elapsed)
+
+        trace = current_trace.get()
+        if trace is not None:
+            trace.record(" ".join(self.key) or self.histogram.name, elapsed)
+
+
+class Registry:
+    """The set of metrics exposed by a process."""
+    def __init__(self) -> None:
+        self._metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: M) -> M:
+        self._metrics[metric.name] = metric
+        return metric
+
+    def __iter__(self) -> Iterator[Metric]:
+        return iter(list(self._metrics.values()))
+
+    def collect(self) -> Dict[str, Values]:
+        """Copy the current values of every metric."""
+        collected = {}
+        for metric in self:
+            try:
+                collected[metric.name] = metric.collect()
+            except Exception:
+                logger.exception(f"Could not collect metric: {metric.name}")
+        return collected
+
+    def render(self, collected: Optional[Dict[str, Values]] = None) -> str:
+        """
+        Render every metric in the Prometheus text format, or the given
+        values of them.
+        """
+        if collected is None:
+            collected = self.collect()
+        lines = []
+        for metric in self:
+            if metric.name in collected:
+                lines.extend(metric.render(collected[metric.name]))
+        return "\n".join(lines) + "\n"
+
+
+class SharedMetrics:
+    """
+    Shares the metrics of the workers of a multi-worker server, so that a
+    scrape answered by any one of them adds up the metrics of them all.
+
+    Every interval seconds, and whenever it answers a scrape, each worker
+    writes its metrics to a file of its own in a directory the workers
+    share. A scrape adds up the last metrics written by every worker. Only
+    the files are read, never the live metrics of the worker answering, so
+    counters keep going up whichever worker answers. The counters of
+    workers which have exited are kept, but their gauges are not.
+    """
+    def __init__(
+            self,
+            registry: Registry,
+            directory: str,
+            interval: float = DEFAULT_SHARE_INTERVAL
+    ) -> None:
+        self.registry = registry
+        self.directory = directory
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        """Start sharing this worker's metrics in the background."""
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._share())
+
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self.write()
+
+    async def _share(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                self.write()
+            except Exception:
+                logger.exception("Could not share metrics")
+
+    def write(self) -> None:
+        """Write this worker's metrics to its file."""
+        collected = {
+            name: [[list(key), value] for key, value in values.items()]
+            for name, values in self.registry.collect().items()
+        }
+        path = os.path.join(self.directory, f"{os.getpid()}.json")
+        # Replace the file in one step so that it is never read half
+        # written.
+        partial_path = path + ".partial"
+        with open(partial_path, "w") as metrics_file:
+            json.dump(collected, metrics_file)
+        os.replace(partial_path, path)
+
+    def render(self) -> str:
+        """Render the metrics of every worker, added up."""
+        self.write()
+        totals: Dict[str, Values] = {}
+        metrics = {metric.name: metric for metric in self.registry}
+        for pid, collected in self._read():
+            alive = _is_running(pid)
+            for name, values in collected.items():
+                metric = metrics.get(name)
+                if metric is None or \
+                        (isinstance(metric, Gauge) and not alive):
+                    continue
+                total = totals.setdefault(name, {})
+                for key, value in values:
+                    key = tuple(key)
+                    total[key] = metric.add(total[key], value) \
+                        if key in total else value
+        return self.registry.render(totals)
+
+    def _read(self) -> Iterable[Tuple[int, Dict[str, List[Any]]]]:
+        for filename in os.listdir(self.directory):
+            pid, extension = os.path.splitext(filename)
+            if extension != ".json" or not pid.isdigit():
+                continue
+            try:
+                with open(os.path.join(self.directory, filename)) as file:
+                    yield int(pid), json.load(file)
+            except (OSError, ValueError) as e:
+                logger.warning(f"Could not read metrics of worker {pid}: {e}")
+
+
+def _is_running(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+REGISTRY = Registry()
+
+# How long each stage of handling a frame takes.
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    "cornea_stage_seconds",
+    "Time spent in each stage of handling a frame.",
+    ["stage"]
+))
+STREAM_FRAMES = REGISTRY.register(Counter(
+    "cornea_stream_frames_total",
+    "Frames handled for each stream.",
+    ["stream"]
+))
+STREAM_FRAMES_SKIPPED = REGISTRY.register(Counter(
+    "cornea_stream_frames_skipped_total",
+    "Frames of each stream not searched because nothing moved in them.",
+    ["stream"]
+))
+MODEL_LOAD_SECONDS = REGISTRY.register(Histogram(
+    "cornea_model_load_seconds",
+    "Time taken to load a model.",
+    buckets=DURATION_BUCKETS
+))
+TRAINING_SECONDS = REGISTRY.register(Histogram(
+    "cornea_training_seconds",
+    "Time taken by training jobs, by their outcome.",
+    ["status"],
+    buckets=DURATION_BUCKETS
+))
+RESULT_CACHE_LOOKUPS = REGISTRY.register(Counter(
+    "cornea_result_cache_lookups_total",
+    "Frames looked up in the result cache, by whether a result was found "
+    "for the same frame, a near duplicate of it, or not at all.",
+    ["result"]
+))
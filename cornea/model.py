@@ -1,13 +1,12 @@
 from __future__ import annotations
-from typing import Union, Tuple, Optional, List, Dict, Any
+from typing import Union, Tuple, Optional, List, Dict, Any, Callable
 from pathlib import Path
 from io import BytesIO
 import logging
+import threading
 from datetime import datetime
 import os
 
-from PIL import Image
-
 import numpy as np
 from numpy.typing import NDArray
 import cv2
@@ -16,22 +15,130 @@ from cv2.face import LBPHFaceRecognizer_create
 
 from cornea.frame import Frame
 from cornea.config import Config
+from cornea.detection import FaceDetector, Region
+from cornea.metrics import STAGE_SECONDS, MODEL_LOAD_SECONDS
+from cornea.index import HistogramIndex, face_histogram
+from cornea.model_file import MODEL_FILE_EXTENSION, Samples, read_model_file, \
+    write_model_file
 
 HAAR_CASCADE_DATA = 'haarcascade_frontalface_default.xml'
 
+# Face crops are resized to this (width, height) before training and
+# prediction so that every LBPH histogram describes the face at one scale.
+FACE_SIZE = (100, 100)
+
+# Only files with these extensions in the model directory are models. Models
+# are written in Cornea's own format, older models written by OpenCV as YAML
+# can still be loaded.
+MODEL_EXTENSIONS = (MODEL_FILE_EXTENSION, ".yml")
+# File in the model directory naming the model to serve in place of the
+# latest one, if a model has been pinned.
+MODEL_PIN_FILE = ".pinned"
+
+# How many training records to process between progress reports.
+PROGRESS_INTERVAL = 100
+
+ProgressCallback = Callable[[Dict[str, Any]], None]
+# The tag, confidence and location of a face recognised in a frame.
+Match = Tuple[int, float, Dict[str, int]]
+
 logger = logging.getLogger(__name__)
 
 
+def list_model_files(model_dir: str) -> List[str]:
+    """Get the paths of the models in a directory, oldest first."""
+    models = [os.path.join(model_dir, basename) for basename \
+              in os.listdir(model_dir) \
+              if basename.lower().endswith(MODEL_EXTENSIONS)]
+    return sorted(models, key=os.path.getctime)
+
+
 def get_latest_model_file(model_dir: str) -> Optional[str]:
     """Get the most recently created model file and return its path."""
-    models = [os.path.join(model_dir, basename) for basename \
-              in os.listdir(model_dir)]
+    models = list_model_files(model_dir)
+    if not models:
+        return None
+
+    return models[-1]
+
+
+def get_pinned_model_file(model_dir: str) -> Optional[str]:
+    """
+    Get the path of the model pinned in a directory, if there is one. A pin
+    naming a model which no longer exists is removed, so that the latest
+    model is served instead.
+    """
     try:
-        latest = max(models, key=os.path.getctime)
-    except ValueError:
+        with open(os.path.join(model_dir, MODEL_PIN_FILE), "r") as pin_file:
+            name = pin_file.read().strip()
+    except FileNotFoundError:
+        return None
+    if not name:
+        return None
+
+    model_path = os.path.join(model_dir, name)
+    if not os.path.isfile(model_path):
+        logger.warning(f"Pinned model no longer exists, unpinning it: "
+                       f"{model_path}")
+        pin_model_file(model_dir, None)
         return None
 
-    return latest
+    return model_path
+
+
+def pin_model_file(model_dir: str, model_path: Optional[str]) -> None:
+    """
+    Pin a model so that it is served rather than the latest model, or unpin
+    the pinned model if model_path is None.
+    """
+    pin_path = os.path.join(model_dir, MODEL_PIN_FILE)
+    if model_path is None:
+        try:
+            os.remove(pin_path)
+        except FileNotFoundError:
+            pass
+        return
+
+    # Replace the pin in one step so that it is never read half written.
+    partial_path = pin_path + ".partial"
+    with open(partial_path, "w") as pin_file:
+        pin_file.write(os.path.basename(model_path))
+    os.replace(partial_path, pin_path)
+
+
+def get_serving_model_file(model_dir: str) -> Optional[str]:
+    """Get the model which should be served, the pinned or latest model."""
+    return get_pinned_model_file(model_dir) or get_latest_model_file(model_dir)
+
+
+def normalise_face(face: NDArray[np.uint8]) -> NDArray[np.uint8]:
+    """Resize a grayscale face crop to FACE_SIZE."""
+    if face.shape[::-1] == FACE_SIZE:
+        return face
+    return cv2.resize(face, FACE_SIZE, interpolation=cv2.INTER_AREA)
+
+
+def create_classifier() -> CascadeClassifier:
+    """Create the Haar cascade used to find faces."""
+    return CascadeClassifier(cv2.data.haarcascades + HAAR_CASCADE_DATA)
+
+
+def extract_faces(
+        classifier: CascadeClassifier,
+        image_data: bytes) -> List[NDArray[np.uint8]]:
+    """
+    Find the faces in an encoded image and return them as grayscale crops
+    normalised to FACE_SIZE.
+    """
+    # Pillow is only needed to read ingested images.
+    from PIL import Image
+
+    img = Image.open(BytesIO(image_data)).convert('L')
+    np_arr = np.array(img, 'uint8')
+
+    found_faces = classifier.detectMultiScale(np_arr)
+    return [normalise_face(np_arr[y:y+h, x:x+w])
+            for (x, y, w, h) in found_faces]
 
 
 def ensure_model_folder_exists(model_dir: str) -> None:
@@ -51,7 +158,7 @@ def ensure_model_folder_exists(model_dir: str) -> None:
 
 class Model:
     """
-    Class to represent a OpenCV LBPH model. This class manages the
+    Class to represent an LBPH model. This class manages the
     loading/reloading of models as well as training new models and
     predicting faces from image data.
     """    
@@ -62,13 +169,33 @@ class Model:
             do_load: bool = True
     ) -> None:
         self.model_path = model_path
-        self.classifier = CascadeClassifier(
-            cv2.data.haarcascades + HAAR_CASCADE_DATA)
-        self.recognizer = LBPHFaceRecognizer_create()
         self.config = config
+        self.detector = FaceDetector.from_config(config)
+        # The histograms of the loaded model, which faces are matched
+        # against.
+        self.index: Optional[HistogramIndex] = None
+        # Histograms fitted since the model was loaded, which are written
+        # after the loaded ones when the model is saved.
+        self._samples: List[Samples] = []
+        self.loaded = False
+        # Training generation of the loaded model, if known.
+        self.generation: Optional[int] = None
+        self._local = threading.local()
 
         if do_load:
             self._load_model(self.model_path)
+
+    @property
+    def classifier(self) -> CascadeClassifier:
+        """
+        The Haar cascade used to find faces. CascadeClassifier is not safe to
+        share between threads, so each inference worker gets its own.
+        """
+        classifier = getattr(self._local, "classifier", None)
+        if classifier is None:
+            classifier = create_classifier()
+            self._local.classifier = classifier
+        return classifier
     
     def _load_model(
             self,
@@ -77,19 +204,40 @@ class Model:
         ) -> None:
         """
         Load a model from the model directory.
-        If latest is set the most recent model is loaded.
+        If latest is set the pinned model, or otherwise the most recent
+        model, is loaded.
         """
         model_dir = self.config.model_dir
         ensure_model_folder_exists(model_dir)
         if latest or model_path is None:
-            model_path = get_latest_model_file(model_dir)
+            model_path = get_serving_model_file(model_dir)
         
         if model_path is None:
             raise RuntimeError('No models have been trained yet. To train '
                                'a model, please run "cornea --train".')
 
         logger.info(f"Loading model: {model_path}")
-        self.recognizer.read(model_path)
+        candidate_tags = self.config.recognition.get("candidate_tags") or 0
+        with MODEL_LOAD_SECONDS.time():
+            if str(model_path).endswith(MODEL_FILE_EXTENSION):
+                index, generation = read_model_file(
+                    model_path, candidate_tags)
+            else:
+                # Models from before Cornea had its own format were written
+                # by OpenCV's recognizer, so have it parse them.
+                recognizer = LBPHFaceRecognizer_create()
+                recognizer.read(model_path)
+                index = HistogramIndex.from_recognizer(
+                    recognizer, candidate_tags)
+                # They recorded the highest face.id they included, which
+                # is not a reliable mark of which faces they hold.
+                generation = None
+
+        self.index = index
+        self._samples = []
+        self.model_path = model_path
+        self.generation = generation
+        self.loaded = True
     
     @classmethod
     def load_model(
@@ -100,98 +248,267 @@ class Model:
     ) -> Model:
         """Load a model and return the model instance."""
         return cls(model_path, config, actually_load)
+
+    @classmethod
+    def from_file(
+        cls,
+        model_path: Union[str, Path],
+        config: Config
+    ) -> Model:
+        """Load a specific model file rather than the most recent one."""
+        model = cls(model_path, config, False)
+        model._load_model(model_path, latest=False)
+        return model
     
     def train(
             self,
-            training_data: List[Tuple[bytes, int]],
-            output_path: Optional[str] = None
-        ) -> None:
+            training_data: List[Tuple[bytes, int, int, int]],
+            output_path: Optional[str] = None,
+            progress: Optional[ProgressCallback] = None,
+            reload: bool = True,
+            generation: Optional[int] = None
+        ) -> str:
         """
-        Train a model from all training data in the database. If this
+        Train a model from all face crops in the database. If this
         occurs while serving the API, the newley trained model is reloaded
-        automatically.
+        automatically unless reload is unset.
+        generation is the training generation of the face crops in the
+        training data and is recorded with the model so that it can be
+        updated incrementally.
+        Returns the path the new model was written to.
+        """
+        logger.info("Training model, this may take a while.")
+        if not self.fit(training_data, progress=progress):
+            raise RuntimeError("No face crops were found to train on.")
+
+        return self.save(output_path, progress, reload, generation)
+
+    def update(
+            self,
+            training_data: List[Tuple[bytes, int, int, int]],
+            output_path: Optional[str] = None,
+            progress: Optional[ProgressCallback] = None,
+            reload: bool = True,
+            generation: Optional[int] = None
+        ) -> str:
+        """
+        Add new face crops to the loaded model rather than training a new
+        model from scratch, then write the result as a new model.
+        Returns the path the new model was written to.
+        """
+        if not self.loaded:
+            raise RuntimeError("A model must be loaded before it can be "
+                               "updated.")
+
+        samples = self.fit(training_data, update=True, progress=progress)
+        if samples:
+            logger.info(f"Updated model with {samples} new samples.")
+        else:
+            logger.info("No new faces were found in the training data.")
+
+        return self.save(output_path, progress, reload, generation)
+
+    def fit(
+            self,
+            training_data: List[Tuple[bytes, int, int, int]],
+            update: bool = False,
+            progress: Optional[ProgressCallback] = None
+        ) -> int:
+        """
+        Compute the histograms of a batch of face crop records to add to the
+        model. Unless update is set this replaces whatever the model held
+        before, so a large training set can be fitted one chunk at a time by
+        updating with every chunk after the first.
+        Returns the number of samples added.
         """
-        training_data = self.prepare_training_data(training_data)
-        logger.info("Training OpenCV model, this may take a while.")
-        self.recognizer.train(training_data[0], training_data[1])
+        if not update:
+            self.index = None
+            self._samples = []
 
+        faces, tags = self.prepare_training_data(training_data, progress)
+        if not faces:
+            return 0
+
+        params = HistogramIndex.empty() if self.index is None else self.index
+        histograms = np.empty((len(faces), params.dimensions), np.float32)
+        for row, face in enumerate(faces):
+            histograms[row] = face_histogram(
+                face,
+                params.radius,
+                params.neighbors,
+                params.grid_x,
+                params.grid_y
+            )
+
+        self._samples.append((histograms, tags.astype(np.int32)))
+        return len(faces)
+
+    def save(
+            self,
+            output_path: Optional[str] = None,
+            progress: Optional[ProgressCallback] = None,
+            reload: bool = True,
+            generation: Optional[int] = None
+        ) -> str:
+        """
+        Write the loaded histograms and any fitted since out as a new model,
+        recording generation in its header. Unless reload is set, the model
+        continues to serve predictions from the histograms it had loaded.
+        Returns the path the model was written to.
+        """
         if output_path is None:
             output_path = self.format_model_path(
                 self.config.model_dir)
         
-        logger.info(f"Writing OpenCV model to: {output_path}")
-        self.recognizer.write(output_path)
+        logger.info(f"Writing model to: {output_path}")
+        if progress is not None:
+            progress({"stage": "writing"})
+        samples = write_model_file(
+            output_path, self.index, self._samples, generation)
+        logger.info(f"Wrote model with {samples} samples.")
+        self._samples = []
+        self.generation = generation
 
-        logger.info(
-            f"Reloading model for model: {self.model_path} -> {output_path}")
-        self._load_model(output_path)
+        if reload:
+            logger.info(
+                f"Reloading model for model: {self.model_path} -> "
+                f"{output_path}")
+            self._load_model(output_path, latest=False)
         self.model_path = output_path
+
+        return output_path
     
     def prepare_training_data(
             self,
-            training_data: List[Tuple[bytes, int]]
+            training_data: List[Tuple[bytes, int, int, int]],
+            progress: Optional[ProgressCallback] = None
     ) -> Tuple[List[NDArray], List[NDArray]]:
         """
-        Process training data from the database by converting records into
-        a tuple of lists of NumPY arrays of image data and their associated
-        tags.
+        Process training data from the database by converting face crop
+        records of (crop_data, width, height, tag) into a tuple of lists of
+        NumPY arrays of image data and their associated tags.
         """
         logger.info("Preparing OpenCV training data...")
         faces = []
         tags = []
-        for entry in training_data:
-            img = Image.open(BytesIO(entry[0])).convert('L')
-            np_arr = np.array(img, 'uint8')
-
-            found_faces = self.classifier.detectMultiScale(np_arr)
-            for (x, y, w, h) in  found_faces:
-                faces.append(np_arr[y:y+h, x:x+w])
-                tags.append(entry[1])
+        for i, (crop_data, width, height, tag) in enumerate(
+                training_data, start=1):
+            crop = np.frombuffer(crop_data, dtype=np.uint8)
+            faces.append(normalise_face(crop.reshape(height, width)))
+            tags.append(tag)
+
+            if progress is not None and (
+                    i % PROGRESS_INTERVAL == 0 or i == len(training_data)):
+                progress({
+                    "stage": "preparing",
+                    "records_processed": i,
+                    "records_total": len(training_data),
+                    "samples_prepared": len(faces)
+                })
         
         return faces, np.array(tags)
+
+    def extract_faces(self, image_data: bytes) -> List[NDArray[np.uint8]]:
+        """
+        Find the faces in an encoded image and return them as grayscale crops
+        normalised to FACE_SIZE, ready to be stored as training data.
+        """
+        return extract_faces(self.classifier, image_data)
     
-    async def handle_frame(
-            self, frame: bytes) -> Optional[Tuple[str, float, dict]]:
-        """
-        Handle an incoming frame from the API and perform a prediction on the
-        frame to determine the face in the image, if any.
-        Returns a tuple containing the tag, the confidence in the prediction,
-        and the location (x, y, w, h) of the face in the image, for graphical
-        applications.
-        """
-        frame = Frame(frame)
-        data = cv2.imdecode(frame.frame_data, cv2.IMREAD_GRAYSCALE)
-
-        faces = self.classifier.detectMultiScale(
-            data,
-            scaleFactor=1.2,
-            minNeighbors=5,
-        )
+    def decode_frame(self, frame: Union[bytes, Frame]) -> NDArray[np.uint8]:
+        """Decode a frame at the size faces are detected and recognised at."""
+        if not isinstance(frame, Frame):
+            frame = Frame(frame)
+        with STAGE_SECONDS.time(stage="decode"):
+            return frame.decode(self.detector.decode_reduction)
+
+    def detect_faces(
+            self,
+            image: NDArray[np.uint8],
+            region: Optional[Region] = None,
+            min_size: int = 0,
+            max_size: int = 0
+    ) -> NDArray[np.int32]:
+        """
+        Find the faces in a decoded frame, returning the (x, y, w, h) of
+        each one. The search can be limited to a region of the image and to
+        faces between min_size and max_size pixels across, which otherwise
+        default to the limits in the detection config.
+        """
+        with STAGE_SECONDS.time(stage="detect"):
+            faces = self.detector.detect(
+                self.classifier, image, region, min_size, max_size)
         logger.debug("Faces detected: {}".format(faces))
-        
-        for (x, y, w, h) in faces:
-            location = {"x": int(x), "y": int(y), "w": int(w), "h": int(h)}
+        return faces
+
+    def to_frame_coordinates(self, matches: List[Match]) -> List[Match]:
+        """
+        Convert the locations of faces found in a decoded frame to the
+        coordinates of the full frame, if it was decoded at a reduced size.
+        """
+        reduction = self.detector.decode_reduction
+        if reduction == 1:
+            return matches
+
+        return [
+            (tag, confidence,
+             {key: value * reduction for key, value in location.items()})
+            for tag, confidence, location in matches
+        ]
+
+    def predict_face(
+            self,
+            image: NDArray[np.uint8],
+            box: Tuple[int, int, int, int]) -> Match:
+        """Recognise the face found at box (x, y, w, h) in an image."""
+        x, y, w, h = box
+        location = {"x": int(x), "y": int(y), "w": int(w), "h": int(h)}
 
-            face_fingerprint, confidence = self.recognizer.predict(
-                data[y:y+h, x:x+w]
+        with STAGE_SECONDS.time(stage="predict"):
+            face_fingerprint, confidence = self.index.predict(
+                normalise_face(image[y:y+h, x:x+w])
             )
-            confidence = 1 - (confidence / 100)
-
-            logger.debug("Face hit: fingerprint: {} confidence: {} "
-                         "(x: {}, y: {}, w: {}, h: {})".format(
-                             face_fingerprint,
-                             confidence,
-                             location["x"],
-                             location["y"],
-                             location["w"],
-                             location["h"]
-                         ))
-
-            return face_fingerprint, confidence, location
-    
+        confidence = 1 - (confidence / 100)
+
+        logger.debug("Face hit: fingerprint: {} confidence: {} "
+                     "(x: {}, y: {}, w: {}, h: {})".format(
+                         face_fingerprint,
+                         confidence,
+                         location["x"],
+                         location["y"],
+                         location["w"],
+                         location["h"]
+                     ))
+
+        return face_fingerprint, confidence, location
+
+    def handle_frame(
+            self,
+            frame: Union[bytes, Frame],
+            region: Optional[Region] = None) -> List[Match]:
+        """
+        Handle an incoming frame from the API and perform a prediction on
+        every face found in the frame, or in a region of it. The frame may be
+        encoded image data or an already constructed Frame.
+        Returns a list with a tuple for each face containing the tag, the
+        confidence in the prediction, and the location (x, y, w, h) of the
+        face in the image, for graphical applications.
+
+        The frame is decoded and searched for faces once however many faces
+        it contains. This blocks for the duration of the prediction, so the
+        server runs it in the inference executor rather than on the event
+        loop.
+        """
+        data = self.decode_frame(frame)
+
+        return self.to_frame_coordinates([
+            self.predict_face(data, box)
+            for box in self.detect_faces(data, region)
+        ])
+
     def get_current_timestamp(self) -> str:
         """Get a timestamp of the current datetime"""
-        dt_format = "%d_%m_%y_%H%M%S"
+        dt_format = "%d_%m_%y_%H%M%S_%f"
         return datetime.strftime(datetime.now(), dt_format)
     
     def format_model_path(self, model_dir: str) -> str:
@@ -199,6 +516,6 @@ class Model:
         if not os.path.isdir(model_dir):
             raise RuntimeError('Model directory does not exist.')
         file_str = model_dir + "/cornea_cv_"
-        file_str += self.get_current_timestamp() + '.yml'
+        file_str += self.get_current_timestamp() + MODEL_FILE_EXTENSION
 
         return os.path.abspath(file_str)
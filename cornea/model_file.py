@@ -0,0 +1,164 @@
+from __future__ import annotations
+import os
+import struct
+import logging
+from pathlib import Path
+from typing import Iterable, Optional, Tuple, Union
+
+import numpy as np
+from numpy.typing import NDArray
+
+from cornea.index import HistogramIndex
+
+logger = logging.getLogger(__name__)
+
+MODEL_FILE_EXTENSION = ".cornea"
+
+MODEL_FILE_MAGIC = b"CORNEAMD"
+MODEL_FILE_VERSION = 2
+# Version 1 files recorded the highest face.id they included rather than a
+# training generation, which is not a reliable mark of which faces a model
+# holds, so it is ignored when they are read.
+LEGACY_MODEL_FILE_VERSION = 1
+
+# The header is followed by three blocks which start at fixed offsets, so that
+# each can be memory mapped directly:
+#   - the histograms, count x dimensions float32 values, one row per sample.
+#   - the sum of each histogram, count float64 values.
+#   - the tag of each histogram, count int32 values.
+# All values are little endian.
+_HEADER = struct.Struct(
+    "<"
+    "8s"  # magic
+    "H"   # version
+    "H"   # LBP radius
+    "H"   # LBP neighbours
+    "H"   # grid x
+    "H"   # grid y
+    "H"   # reserved
+    "Q"   # number of samples
+    "I"   # histogram dimensions
+    "q"   # training generation of the model, -1 if unknown
+    "d"   # distance threshold
+    "16x"
+)
+HEADER_SIZE = _HEADER.size
+
+# A block of histograms, one row per sample, and the tag of each row.
+Samples = Tuple[NDArray[np.float32], NDArray[np.int32]]
+
+
+class InvalidModelFile(ValueError):
+    """Raised when a file is not a model written by Cornea."""
+    pass
+
+
+def write_model_file(
+        path: Union[str, Path],
+        index: Optional[HistogramIndex],
+        samples: Iterable[Samples] = (),
+        generation: Optional[int] = None) -> int:
+    """
+    Write the histograms of an index followed by any new samples as a model
+    file. The histograms are streamed to disk block by block rather than
+    being joined in memory first, and the file only appears at path once it
+    has been written in full.
+    Returns the number of samples written.
+    """
+    samples = list(samples)
+    blocks = []
+    if index is not None:
+        blocks.append((index.histograms, index.totals, index.labels))
+    for histograms, labels in samples:
+        blocks.append((
+            histograms,
+            histograms.sum(axis=1, dtype=np.float64),
+            labels.astype(np.int32)
+        ))
+
+    params = index if index is not None else HistogramIndex.empty()
+    count = sum(len(histograms) for histograms, _, _ in blocks)
+    dimensions = params.dimensions
+    for histograms, _, _ in blocks:
+        if histograms.shape[1] != dimensions:
+            raise ValueError(
+                f"Histograms have {histograms.shape[1]} dimensions, "
+                f"expected {dimensions}.")
+
+    header = _HEADER.pack(
+        MODEL_FILE_MAGIC,
+        MODEL_FILE_VERSION,
+        params.radius,
+        params.neighbors,
+        params.grid_x,
+        params.grid_y,
+        0,
+        count,
+        dimensions,
+        -1 if generation is None else generation,
+        params.threshold
+    )
+
+    partial_path = f"{path}.partial"
+    with open(partial_path, "wb") as model_file:
+        model_file.write(header)
+        for position, dtype in enumerate(("<f4", "<f8", "<i4")):
+            for block in blocks:
+                model_file.write(
+                    np.ascontiguousarray(block[position], dtype=dtype).data)
+    os.replace(partial_path, path)
+
+    return count
+
+
+def read_model_file(
+        path: Union[str, Path],
+        candidate_tags: int = 0) -> Tuple[HistogramIndex, Optional[int]]:
+    """
+    Open a model file, returning an index over its histograms and the
+    training generation of the model, if known.
+
+    The histograms are memory mapped rather than read, so opening a model is
+    near instant whatever its size, and every process serving the same model
+    shares a single copy of it in memory.
+    """
+    with open(path, "rb") as model_file:
+        header = model_file.read(HEADER_SIZE)
+    if len(header) < HEADER_SIZE:
+        raise InvalidModelFile(f"Model file is truncated: {path}")
+
+    (magic, version, radius, neighbors, grid_x, grid_y, _, count,
+     dimensions, generation, threshold) = _HEADER.unpack(header)
+    if magic != MODEL_FILE_MAGIC:
+        raise InvalidModelFile(f"Not a Cornea model file: {path}")
+    if version == LEGACY_MODEL_FILE_VERSION:
+        generation = -1
+    elif version != MODEL_FILE_VERSION:
+        raise InvalidModelFile(
+            f"Unsupported model file version {version}: {path}")
+
+    expected_size = HEADER_SIZE + count * (dimensions * 4 + 8 + 4)
+    if os.path.getsize(path) != expected_size:
+        raise InvalidModelFile(f"Model file is truncated: {path}")
+
+    def mapped(dtype: str, offset: int, shape: Tuple[int, ...]) -> NDArray:
+        if not count:
+            return np.empty(shape, dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode="r", offset=offset,
+                         shape=shape)
+
+    totals_offset = HEADER_SIZE + count * dimensions * 4
+    labels_offset = totals_offset + count * 8
+    index = HistogramIndex(
+        mapped("<f4", HEADER_SIZE, (count, dimensions)),
+        mapped("<i4", labels_offset, (count,)),
+        radius=radius,
+        neighbors=neighbors,
+        grid_x=grid_x,
+        grid_y=grid_y,
+        threshold=threshold,
+        candidate_tags=candidate_tags,
+        totals=mapped("<f8", totals_offset, (count,))
+    )
+
+    return index, None if generation < 0 else generation
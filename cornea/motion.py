@@ -0,0 +1,111 @@
+from __future__ import annotations
+from typing import Any, Dict, Optional
+
+import cv2
+import numpy as np
+from numpy.typing import NDArray
+
+from cornea.detection import Region, clip_region
+
+DEFAULT_THRESHOLD = 0.01
+DEFAULT_PIXEL_THRESHOLD = 15
+DEFAULT_LEARNING_RATE = 0.05
+DEFAULT_MAX_SKIPPED = 100
+
+# Frames are shrunk to this width, keeping their aspect ratio, to be
+# compared with the background.
+GATE_WIDTH = 64
+
+
+class MotionGate:
+    """
+    Tells whether anything has moved in the frames of a stream, so that a
+    stream of a still scene is not searched for faces frame after frame.
+
+    The gate keeps a small background image of the stream, a running
+    average of its frames shrunk to GATE_WIDTH pixels across, which adapts
+    to slow changes such as the light at learning_rate. Something has moved
+    once more than a threshold fraction of the pixels of a frame differ from
+    the background by over pixel_threshold grey levels. Frames are let
+    through anyway after max_skipped frames in a row have been held back, or
+    never if max_skipped is 0.
+
+    A gate is not thread safe, it belongs to the tracker of one stream.
+    """
+    def __init__(
+            self,
+            threshold: float = DEFAULT_THRESHOLD,
+            pixel_threshold: float = DEFAULT_PIXEL_THRESHOLD,
+            learning_rate: float = DEFAULT_LEARNING_RATE,
+            max_skipped: int = DEFAULT_MAX_SKIPPED
+    ) -> None:
+        self.threshold = threshold
+        self.pixel_threshold = pixel_threshold
+        self.learning_rate = learning_rate
+        self.max_skipped = max_skipped
+        self._background: Optional[NDArray[np.float32]] = None
+        self._skipped_in_row = 0
+
+    @classmethod
+    def for_stream(
+            cls,
+            settings: Dict[str, Any],
+            stream_id: str) -> Optional[MotionGate]:
+        """
+        Create a gate for a stream from the motion_gate section of the
+        config, in which the settings of a stream listed under streams
+        override the others. Returns None if the gate is not enabled for the
+        stream.
+        """
+        settings = {**settings, **(settings.get("streams") or {}).get(
+            stream_id, {})}
+        if not settings.get("enabled"):
+            return None
+
+        return cls(
+            threshold=settings.get("threshold", DEFAULT_THRESHOLD),
+            pixel_threshold=settings.get(
+                "pixel_threshold", DEFAULT_PIXEL_THRESHOLD),
+            learning_rate=settings.get(
+                "learning_rate", DEFAULT_LEARNING_RATE),
+            max_skipped=settings.get("max_skipped", DEFAULT_MAX_SKIPPED)
+        )
+
+    def moved(
+            self,
+            image: NDArray[np.uint8],
+            region: Optional[Region] = None) -> bool:
+        """
+        Compare the next frame of the stream, or a region of it, with the
+        background, returning whether anything has moved.
+        """
+        if region is not None:
+            x, y, w, h = clip_region(region, image.shape[1], image.shape[0])
+            image = image[y:y + h, x:x + w]
+        height, width = image.shape[:2]
+        if not height or not width:
+            return True
+
+        size = (GATE_WIDTH, max(1, round(height * GATE_WIDTH / width)))
+        small = cv2.resize(
+            image, size, interpolation=cv2.INTER_AREA).astype(np.float32)
+
+        # The first frame, or one of a new size, starts a new background.
+        if self._background is None or \
+                self._background.shape != small.shape:
+            self._background = small
+            self._skipped_in_row = 0
+            return True
+
+        changed = np.count_nonzero(
+            cv2.absdiff(small, self._background) > self.pixel_threshold)
+        cv2.accumulateWeighted(small, self._background, self.learning_rate)
+
+        if changed > self.threshold * small.size or \
+                (self.max_skipped and
+                 self._skipped_in_row >= self.max_skipped):
+            self._skipped_in_row = 0
+            return True
+
+        self._skipped_in_row += 1
+        return False
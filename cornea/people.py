@@ -0,0 +1,167 @@
+from __future__ import annotations
+import asyncio
+import logging
+from typing import Dict, Optional, Set
+
+from asyncpg import Connection, Pool
+
+from cornea import database
+from cornea.database import Person, PERSON_CHANNEL
+from cornea.config import Config
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SIZE = 10000
+
+# How long to wait before listening again after losing the connection.
+RECONNECT_DELAY = 5.0
+
+
+class PersonCache:
+    """
+    Keeps the people in the database in memory so that the tags of
+    recognised faces can be given names without querying the database.
+
+    Up to size people are loaded when the cache starts. The cache then
+    listens for the notifications write_person sends, and adds new people
+    as they are written. A tag which is not in the cache is looked up in the
+    background, so it is named from the next frame on. Once the cache is
+    full, the people loaded first make room for newer ones. A size of 0
+    keeps everyone.
+
+    get may be called from any thread, everything else must be called from
+    the event loop.
+    """
+    def __init__(self, pool: Pool, size: int = DEFAULT_SIZE) -> None:
+        self.pool = pool
+        self.size = size
+        self._people: Dict[int, Person] = {}
+        # Tags looked up and not found, which are only looked up again once
+        # a person is written.
+        self._missing: Set[int] = set()
+        self._pending: Set[int] = set()
+        self._conn: Optional[Connection] = None
+        # Whether notifications of new people are being received.
+        self._listening = False
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._reconnect: Optional[asyncio.TimerHandle] = None
+
+    @classmethod
+    def from_config(cls, pool: Pool, config: Config) -> PersonCache:
+        """Create a cache from the person_cache section of the config."""
+        return cls(pool, config.person_cache.get("size", DEFAULT_SIZE))
+
+    def __len__(self) -> int:
+        return len(self._people)
+
+    async def start(self) -> None:
+        """Listen for new people and load the people already written."""
+        self._loop = asyncio.get_running_loop()
+        try:
+            self._conn = await self.pool.acquire()
+            self._conn.add_termination_listener(self._on_terminated)
+            # Listen before loading so that no one written in between is
+            # missed.
+            try:
+                await self._conn.add_listener(PERSON_CHANNEL, self._on_notify)
+                self._listening = True
+            except database.CONNECTION_ERRORS:
+                raise
+            except database.PostgresError as e:
+                # Such as the role not being allowed to listen.
+                logger.warning(f"Could not listen for new people, they are "
+                               f"looked up when first recognised.\n{e}")
+                await self._release()
+            people = await database.get_people(self.pool, self.size or None)
+        except (database.DatabaseError, database.PostgresError) + \
+                database.CONNECTION_ERRORS as e:
+            logger.error(f"Could not load people, retrying in "
+                         f"{RECONNECT_DELAY}s.\n{e}")
+            await self._release()
+            self._schedule_reconnect()
+            return
+
+        # Oldest first, so that they are the first to make room.
+        self._people = {person.tag: person for person in reversed(people)}
+        self._missing.clear()
+        logger.info(f"Loaded {len(self._people)} people")
+
+    async def close(self) -> None:
+        self._loop = None
+        if self._reconnect is not None:
+            self._reconnect.cancel()
+            self._reconnect = None
+        await self._release()
+
+    async def _release(self) -> None:
+        self._listening = False
+        conn, self._conn = self._conn, None
+        if conn is None:
+            return
+        if not conn.is_closed():
+            conn.remove_termination_listener(self._on_terminated)
+            await conn.remove_listener(PERSON_CHANNEL, self._on_notify)
+        await self.pool.release(conn)
+
+    def _on_terminated(self, conn: Connection) -> None:
+        # Notifications sent while the connection was down are lost, so
+        # everything is loaded again once it is back.
+        logger.warning("Lost the connection listening for new people")
+        asyncio.ensure_future(self._release())
+        self._schedule_reconnect()
+
+    def _schedule_reconnect(self) -> None:
+        def reconnect() -> None:
+            self._reconnect = None
+            asyncio.ensure_future(self.start())
+
+        self._reconnect = self._loop.call_later(RECONNECT_DELAY, reconnect)
+
+    def _on_notify(
+            self,
+            conn: Connection,
+            pid: int,
+            channel: str,
+            payload: str) -> None:
+        tag = int(payload)
+        self._missing.discard(tag)
+        self._fetch(tag)
+
+    def _fetch(self, tag: int) -> None:
+        if tag in self._pending or tag in self._missing:
+            return
+        self._pending.add(tag)
+        asyncio.ensure_future(self._load(tag))
+
+    async def _load(self, tag: int) -> None:
+        try:
+            person = await database.get_person_by_tag(self.pool, tag)
+        except (database.DatabaseError,) + database.CONNECTION_ERRORS as e:
+            logger.error(f"Could not look up tag: {tag}\n{e}")
+            return
+        finally:
+            self._pending.discard(tag)
+
+        # Without notifications, a person written later would never be
+        # looked up again.
+        if person is None:
+            if self._listening:
+                self._missing.add(tag)
+            return
+        self._add(person)
+
+    def _add(self, person: Person) -> None:
+        self._people.pop(person.tag, None)
+        while len(self._people) >= self.size > 0:
+            del self._people[next(iter(self._people))]
+        self._people[person.tag] = person
+
+    def get(self, tag: int) -> Optional[Person]:
+        """
+        Get the person with a tag if they are in the cache. Otherwise None is
+        returned straight away and the person is looked up in the background.
+        """
+        person = self._people.get(tag)
+        if person is None and tag >= 0 and self._loop is not None:
+            self._loop.call_soon_threadsafe(self._fetch, tag)
+        return person
@@ -0,0 +1,142 @@
+from __future__ import annotations
+import os
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+from numpy.typing import NDArray
+
+from cornea.model import Model, create_classifier, extract_faces
+
+logger = logging.getLogger(__name__)
+
+# Each worker is handed several batches so that the pool stays busy when
+# some images take longer than others.
+BATCHES_PER_WORKER = 4
+
+# The Haar cascade of the current worker process.
+_classifier = None
+
+
+def _init_worker() -> None:
+    global _classifier
+    _classifier = create_classifier()
+
+
+def _extract_batch(
+        images: List[bytes]
+) -> Tuple[Optional[str], List[List[Tuple[int, int]]]]:
+    """
+    Extract the faces from a batch of images inside a worker process.
+
+    The crops are packed back to back into one block of shared memory so
+    that they do not need to be pickled. Returns the name of the block, or
+    None if no faces were found, and the (height, width) of the crops found
+    in each image.
+    """
+    crops = [extract_faces(_classifier, image) for image in images]
+    shapes = [[crop.shape for crop in image_crops] for image_crops in crops]
+
+    size = sum(crop.nbytes for image_crops in crops for crop in image_crops)
+    if not size:
+        return None, shapes
+
+    shm = SharedMemory(create=True, size=size)
+    offset = 0
+    for image_crops in crops:
+        for crop in image_crops:
+            shm.buf[offset:offset + crop.nbytes] = crop.tobytes()
+            offset += crop.nbytes
+
+    # The parent takes ownership of the block and unlinks it, so this
+    # process must not report it as leaked when it exits.
+    resource_tracker.unregister(shm._name, "shared_memory")
+    shm.close()
+    return shm.name, shapes
+
+
+def _unpack_batch(
+        name: Optional[str],
+        shapes: List[List[Tuple[int, int]]]
+) -> List[List[NDArray[np.uint8]]]:
+    """Copy the crops of a batch out of shared memory and free it."""
+    if name is None:
+        return [[] for _ in shapes]
+
+    size = sum(h * w for image_shapes in shapes for h, w in image_shapes)
+    shm = SharedMemory(name=name)
+    try:
+        data = np.frombuffer(shm.buf, dtype=np.uint8, count=size).copy()
+    finally:
+        shm.close()
+        shm.unlink()
+
+    crops = []
+    offset = 0
+    for image_shapes in shapes:
+        image_crops = []
+        for height, width in image_shapes:
+            size = height * width
+            image_crops.append(
+                data[offset:offset + size].reshape(height, width))
+            offset += size
+        crops.append(image_crops)
+    return crops
+
+
+class FaceExtractor:
+    """
+    Extracts face crops from encoded images across a pool of worker
+    processes, each holding its own Haar cascade.
+
+    Results are always returned in the order the images were given, so the
+    training data, and therefore the model, is the same regardless of the
+    number of workers. With a single worker images are processed in the
+    current process.
+    """
+    def __init__(self, model: Model, workers: Optional[int] = None) -> None:
+        self.model = model
+        self.workers = workers or os.cpu_count() or 1
+        self._pool: Optional[ProcessPoolExecutor] = None
+
+        if self.workers > 1:
+            logger.info(f"Starting {self.workers} face extraction workers")
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker
+            )
+
+    def __enter__(self) -> FaceExtractor:
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def extract(
+            self,
+            images: Sequence[bytes]) -> List[List[NDArray[np.uint8]]]:
+        """
+        Find the faces in each image, returning a list of crops normalised to
+        FACE_SIZE for every image.
+        """
+        if self._pool is None or not images:
+            return [self.model.extract_faces(image) for image in images]
+
+        batch_size = -(-len(images) // (self.workers * BATCHES_PER_WORKER))
+        batches = [list(images[i:i + batch_size])
+                   for i in range(0, len(images), batch_size)]
+
+        crops = []
+        for name, shapes in self._pool.map(_extract_batch, batches):
+            crops.extend(_unpack_batch(name, shapes))
+        return crops
+
+    def close(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
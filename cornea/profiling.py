@@ -0,0 +1,183 @@
+from __future__ import annotations
+import io
+import time
+import pstats
+import random
+import logging
+import cProfile
+import itertools
+from collections import deque
+from contextvars import ContextVar
+from datetime import datetime
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple, TypeVar
+
+from cornea.config import Config
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+DEFAULT_THRESHOLD = 0.5
+DEFAULT_TRACES = 50
+# Number of functions listed in a trace's cProfile report.
+PROFILE_FUNCTIONS = 40
+
+# Values of the profiling header asking for a stage timing trace, or a full
+# cProfile trace.
+STAGES = "stages"
+CPROFILE = "cprofile"
+
+# The trace of the request being handled, if it is being traced. Stage
+# timers record themselves in it.
+current_trace: ContextVar[Optional[Trace]] = ContextVar(
+    "current_trace", default=None)
+
+
+class Trace:
+    """The time taken by each stage of handling one request."""
+    def __init__(
+            self,
+            trace_id: int,
+            path: str,
+            forced: bool = False,
+            cprofile: bool = False
+    ) -> None:
+        self.id = trace_id
+        self.path = path
+        self.forced = forced
+        self.cprofile = cprofile
+        self.started = datetime.now()
+        self.duration: Optional[float] = None
+        self.stages: List[Tuple[str, float]] = []
+        self._start = time.perf_counter()
+        self._profiles: List[cProfile.Profile] = []
+
+    def record(self, stage: str, seconds: float) -> None:
+        self.stages.append((stage, seconds))
+
+    def run(self, func: Callable[..., T], *args: Any) -> T:
+        """
+        Call a function as part of the request, such as in an inference
+        worker, tracing the stages it runs and profiling it if asked to.
+        """
+        token = current_trace.set(self)
+        profile = cProfile.Profile() if self.cprofile else None
+        try:
+            if profile is not None:
+                profile.enable()
+            return func(*args)
+        finally:
+            if profile is not None:
+                profile.disable()
+                self._profiles.append(profile)
+            current_trace.reset(token)
+
+    def finish(self) -> float:
+        self.duration = time.perf_counter() - self._start
+        return self.duration
+
+    def profile_report(self) -> Optional[str]:
+        """Format the functions which took the most time, if profiled."""
+        if not self._profiles:
+            return None
+
+        output = io.StringIO()
+        stats = pstats.Stats(self._profiles[0], stream=output)
+        for profile in self._profiles[1:]:
+            stats.add(profile)
+        stats.sort_stats("cumulative").print_stats(PROFILE_FUNCTIONS)
+        return output.getvalue()
+
+    def to_dict(self, profile: bool = False) -> Dict[str, Any]:
+        data = {
+            "id": self.id,
+            "path": self.path,
+            "started": self.started.isoformat(),
+            "duration_ms": self.duration and self.duration * 1000,
+            "forced": self.forced,
+            "stages": [{"stage": stage, "ms": seconds * 1000}
+                       for stage, seconds in self.stages]
+        }
+        if profile:
+            data["profile"] = self.profile_report()
+        return data
+
+
+class Profiler:
+    """
+    Traces requests to find out where the time goes in slow ones.
+
+    A request is traced if it asks to be with the profiling header, or at
+    random for a sample_rate fraction of requests. The time taken by each
+    stage of a traced request is recorded, along with a cProfile profile of
+    its inference if cprofile is set or the header asks for one. Traces of
+    sampled requests which took less than threshold seconds are thrown
+    away, and only the most recent traces are kept.
+
+    Requests which are not traced pay nothing more than a header lookup.
+    """
+    def __init__(
+            self,
+            sample_rate: float = 0.0,
+            threshold: float = DEFAULT_THRESHOLD,
+            cprofile: bool = False,
+            traces: int = DEFAULT_TRACES
+    ) -> None:
+        self.sample_rate = sample_rate
+        self.threshold = threshold
+        self.cprofile = cprofile
+        self.traces: Deque[Trace] = deque(maxlen=traces)
+        self._ids = itertools.count(1)
+
+    @classmethod
+    def from_config(cls, config: Config) -> Optional[Profiler]:
+        """
+        Create a profiler from the profiling section of the config, or None
+        if profiling is not enabled.
+        """
+        profiling = config.profiling
+        if not profiling.get("enabled"):
+            return None
+
+        return cls(
+            sample_rate=profiling.get("sample_rate") or 0.0,
+            threshold=profiling.get("threshold", DEFAULT_THRESHOLD),
+            cprofile=bool(profiling.get("cprofile")),
+            traces=profiling.get("traces", DEFAULT_TRACES)
+        )
+
+    def start(self, path: str, requested: Optional[str]) -> Optional[Trace]:
+        """
+        Start tracing a request if requested, the value of its profiling
+        header, asks for it or it is sampled. The trace is made current until
+        finish is called.
+        """
+        if requested:
+            trace = Trace(next(self._ids), path, forced=True,
+                          cprofile=self.cprofile or requested == CPROFILE)
+        elif self.sample_rate and random.random() < self.sample_rate:
+            trace = Trace(next(self._ids), path, cprofile=self.cprofile)
+        else:
+            return None
+
+        current_trace.set(trace)
+        return trace
+
+    def finish(self, trace: Trace) -> bool:
+        """Finish a trace, returning whether it has been kept."""
+        current_trace.set(None)
+        duration = trace.finish()
+        if not trace.forced and duration < self.threshold:
+            return False
+
+        if not trace.forced:
+            logger.warning(f"Slow request to {trace.path} took "
+                           f"{duration * 1000:.0f}ms, see trace {trace.id}")
+        self.traces.append(trace)
+        return True
+
+    def get(self, trace_id: int) -> Optional[Trace]:
+        for trace in self.traces:
+            if trace.id == trace_id:
+                return trace
+        return None
@@ -4,19 +4,38 @@
 # This project is licesned under the GPL-2.0 License.
 # See the file COPYING for more details.
 
+import os
+import shutil
+import tempfile
+import json as _json
 import base64
 import asyncio
-from concurrent.futures import ThreadPoolExecutor
-from typing import Any, Callable, Coroutine, Dict
-from functools import wraps
+import logging
+import multiprocessing
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 
 from sanic import Sanic, response
 from sanic.request import Request
 from sanic.response import HTTPResponse, json
-from sanic.exceptions import SanicException
+from sanic.server.websockets.impl import WebsocketImplProtocol
 
-from cornea.model import Model
 from cornea import database
+from cornea.model import Model, Match, list_model_files, \
+    get_pinned_model_file, pin_model_file
+from cornea.frame import Frame, InvalidFrame, unpack_frames
+from cornea.config import Config
+from cornea.executor import InferenceExecutor, ExecutorSaturated
+from cornea.jobs import TrainingManager, JobAlreadyRunning
+from cornea.streaming import LatestFrameStream
+from cornea.tracking import TrackerRegistry
+from cornea.watcher import ModelWatcher
+from cornea.people import PersonCache
+from cornea.cache import ResultCache
+from cornea import metrics
+from cornea.metrics import STAGE_SECONDS, STREAM_FRAMES
+from cornea.profiling import Profiler, current_trace
+
+logger = logging.getLogger(__name__)
 
 app = Sanic("cornea_server")
 
@@ -28,70 +47,615 @@ def add_root_route(app: Sanic) -> None:
         return response.text("Hello from Cornea version: 0.0.0-alpha1")
 
 
-def threaded_request(func: Callable[..., Coroutine]) -> Callable:
+# Headers giving the dimensions of raw grayscale frames.
+FRAME_WIDTH_HEADER = "X-Frame-Width"
+FRAME_HEIGHT_HEADER = "X-Frame-Height"
+
+# Header giving the id of the stream, such as a camera, a frame belongs to.
+STREAM_ID_HEADER = "X-Stream-Id"
+
+# Header asking for a request to be traced, and the header of the response
+# giving the id of the trace.
+PROFILE_HEADER = "X-Cornea-Profile"
+TRACE_HEADER = "X-Cornea-Trace"
+
+# Content type of a batch of frames packed with cornea.frame.pack_frames.
+FRAME_BATCH_CONTENT_TYPE = "application/x-cornea-frames"
+DEFAULT_MAX_BATCH_SIZE = 64
+
+
+def get_frame_size(request: Request) -> Optional[Tuple[int, int]]:
+    """
+    Get the (width, height) of the raw frames sent with a request, or None
+    if the frames are encoded images.
+    """
+    headers = request.headers
+    if FRAME_WIDTH_HEADER not in headers and FRAME_HEIGHT_HEADER not in headers:
+        return None
+
+    try:
+        return int(headers[FRAME_WIDTH_HEADER]), \
+            int(headers[FRAME_HEIGHT_HEADER])
+    except (KeyError, ValueError):
+        raise InvalidFrame(
+            f"Raw frames require integer {FRAME_WIDTH_HEADER} and "
+            f"{FRAME_HEIGHT_HEADER} headers.")
+
+
+def parse_frame(request: Request) -> Frame:
+    """
+    Get the frame sent with a request. Frames may be sent as:
+      - JSON, with a base 64 encoded image in the "frame" field.
+      - An encoded image as the request body, with an image/* content type.
+      - Raw 8-bit grayscale pixels as the request body, with the
+        dimensions of the frame in the X-Frame-Width and X-Frame-Height
+        headers.
+    Binary bodies are passed to the model without being copied.
+    """
+    size = get_frame_size(request)
+    if size is not None:
+        return Frame(request.body, *size)
+
+    content_type = request.content_type.split(";")[0].strip().lower()
+    if content_type.startswith("image/"):
+        return Frame(request.body)
+
+    return decode_json_frame(request.json)
+
+
+def parse_frame_batch(request: Request) -> List[Union[bytes, memoryview]]:
+    """
+    Get the data of each frame in a batch sent with a request. A batch may
+    be sent as:
+      - multipart/form-data, with one file per frame.
+      - A body of frames packed with cornea.frame.pack_frames and a content
+        type of application/x-cornea-frames.
+    As with single frames, the frames are raw grayscale pixels if the frame
+    size headers are set.
+    """
+    content_type = request.content_type.split(";")[0].strip().lower()
+    if content_type == "multipart/form-data":
+        return [file.body for files in request.files.values()
+                for file in files]
+    if content_type == FRAME_BATCH_CONTENT_TYPE:
+        return unpack_frames(request.body)
+
+    raise InvalidFrame(
+        "Expected a multipart/form-data or "
+        f"{FRAME_BATCH_CONTENT_TYPE} body.")
+
+
+def decode_json_frame(data: Any) -> Frame:
+    """Get the frame from a JSON body with a base 64 encoded "frame" field."""
+    if not isinstance(data, dict) or "frame" not in data:
+        raise InvalidFrame('Expected a JSON body with a "frame" field.')
+    try:
+        with STAGE_SECONDS.time(stage="base64"):
+            decoded = base64.b64decode(data["frame"], validate=True)
+    except (TypeError, ValueError):
+        raise InvalidFrame("Frame is not valid base 64.")
+    return Frame(decoded)
+
+
+def format_faces(
+        matches: List[Match],
+        people: Optional[PersonCache] = None) -> Dict[str, Any]:
+    """
+    Build the response body for the result of Model.handle_frame, naming
+    each face from the cache of people if there is one.
+    """
+    faces = []
+    for tag, confidence, position in matches:
+        person = people.get(tag) if people is not None else None
+        faces.append({
+            "tag": tag,
+            "name": person.name if person is not None else None,
+            "confidence": confidence,
+            "position": position
+        })
+
+    return {"faces": faces}
+
+
+def invalid_request(error: str) -> HTTPResponse:
+    """Respond to a request with a malformed JSON body with a 400."""
+    return json({"status": "invalid request", "error": error}, status=400)
+
+
+async def run_detection(
+        app: Sanic,
+        frame: Frame,
+        stream_id: Optional[str] = None) -> List[Match]:
+    """
+    Find and recognise the faces in a frame using the inference executor.
+    If the frame belongs to a stream, only the region of interest set for
+    the stream is searched, and the faces found in its previous frames are
+    tracked rather than detected again. Otherwise the result is taken from
+    the result cache if the frame has been seen recently.
+    """
+    model = app.ctx.model
+    region = model.detector.region_for(stream_id)
+    cache = app.ctx.result_cache
+    if stream_id is None and cache is not None:
+        func, args = cache.handle_frame, (model, frame, region)
+    elif stream_id is None:
+        func, args = model.handle_frame, (frame, region)
+    else:
+        STREAM_FRAMES.inc(stream=stream_id)
+        tracker = app.ctx.trackers.get(stream_id)
+        func, args = tracker.handle_frame, (model, frame, region)
+
+    # A traced request is traced in the inference worker too.
+    trace = current_trace.get()
+    if trace is not None:
+        return await app.ctx.executor.run(trace.run, func, *args)
+    return await app.ctx.executor.run(func, *args)
+
+
+def add_frame_errors(app: Sanic) -> None:
+    """Respond to frames which cannot be read with a 400."""
+    @app.exception(InvalidFrame)
+    async def invalid_frame(
+            request: Request, exception: InvalidFrame) -> HTTPResponse:
+        return json({"status": "invalid frame", "error": str(exception)},
+                    status=400)
+
+
+def add_executor(app: Sanic, config: Config) -> None:
+    """
+    Attach the inference executor to the API and reject requests with a 503
+    while it is saturated.
+    """
+    @app.before_server_start
+    async def start_executor(app: Sanic, loop: asyncio.AbstractEventLoop):
+        app.ctx.executor = InferenceExecutor.from_config(config)
+
+    @app.exception(ExecutorSaturated)
+    async def saturated(
+            request: Request, exception: ExecutorSaturated) -> HTTPResponse:
+        return json(
+            {"status": "busy"},
+            status=503,
+            headers={"Retry-After": str(exception.retry_after)}
+        )
+
+    @app.after_server_stop
+    async def shutdown_executor(app: Sanic, loop: asyncio.AbstractEventLoop):
+        app.ctx.executor.shutdown()
+
+
+def add_database(app: Sanic, config: Config) -> None:
+    """
+    Connect to the database once the server has started and load the cache
+    of people used to name faces. Each worker process of the server has its
+    own pool of connections and cache.
+    """
+    @app.before_server_start
+    async def connect_database(app: Sanic, loop: asyncio.AbstractEventLoop):
+        app.ctx.pool = await database.connect_from_config(config.database)
+        app.ctx.people = None
+        if app.ctx.pool is not None:
+            app.ctx.people = PersonCache.from_config(app.ctx.pool, config)
+            await app.ctx.people.start()
+
+    @app.after_server_stop
+    async def close_database(app: Sanic, loop: asyncio.AbstractEventLoop):
+        if app.ctx.people is not None:
+            await app.ctx.people.close()
+        if app.ctx.pool is not None:
+            await app.ctx.pool.close()
+
+
+async def receive_message(
+        ws: WebsocketImplProtocol) -> Optional[Union[str, bytes]]:
+    """
+    Wait for the next complete message on a WebSocket, returning None once
+    the connection has closed.
+    """
+    # WebsocketImplProtocol.recv cannot be used on Python 3.11 with the
+    # pinned version of Sanic, so the message is assembled from its parts.
+    parts = [part async for part in ws.recv_streaming()]
+    if not parts:
+        return None
+    return parts[0][:0].join(parts)
+
+
+def add_stream_route(app: Sanic) -> None:
+    """
+    Add a WebSocket route which clients can push a continuous stream of
+    frames to, receiving a result for each frame processed.
+
+    Binary messages are encoded images, or raw grayscale pixels if the
+    width and height of the frames are given as query arguments when
+    connecting. Text messages are JSON with a base 64 encoded "frame" field,
+    as for detect_frame. Frames sent while the server is still busy with an
+    earlier one are dropped in favour of the most recent. Faces are tracked
+    between frames if a stream id is given as the "stream" query argument.
+    """
+    @app.websocket('/model/stream')
+    async def stream(request: Request, ws: WebsocketImplProtocol) -> None:
+        try:
+            width = request.args.get("width")
+            height = request.args.get("height")
+            size = (int(width), int(height)) if width or height else None
+        except (TypeError, ValueError):
+            await ws.close(code=1008, reason="Invalid frame dimensions.")
+            return
+        stream_id = request.args.get("stream")
+
+        def to_frame(message: Union[str, bytes]) -> Frame:
+            if isinstance(message, str):
+                try:
+                    return decode_json_frame(_json.loads(message))
+                except ValueError as e:
+                    raise InvalidFrame(str(e))
+            if size is not None:
+                return Frame(message, *size)
+            return Frame(message)
+
+        async def process(
+                seq: int, message: Union[str, bytes]) -> Dict[str, Any]:
+            try:
+                frame = to_frame(message)
+                result = await run_detection(app, frame, stream_id)
+            except InvalidFrame as e:
+                return {"frame": seq, "status": "invalid frame",
+                        "error": str(e)}
+            except ExecutorSaturated:
+                return {"frame": seq, "status": "busy"}
+            except Exception:
+                # A frame which breaks detection should not end the stream.
+                logger.exception(f"Could not process frame {seq} of stream")
+                return {"frame": seq, "status": "error"}
+
+            return {"frame": seq, "status": "ok", "dropped": frames.dropped,
+                    **format_faces(result, app.ctx.people)}
+
+        async def send(data: Dict[str, Any]) -> None:
+            with STAGE_SECONDS.time(stage="serialise"):
+                message = _json.dumps(data)
+            await ws.send(message)
+
+        frames = LatestFrameStream(process, send)
+        consumer = asyncio.ensure_future(frames.run())
+        try:
+            while not consumer.done():
+                message = await receive_message(ws)
+                if message is None:
+                    break
+                frames.push(message)
+        finally:
+            frames.close()
+            if consumer.done() and not consumer.cancelled() and \
+                    consumer.exception() is not None:
+                logger.error("Stream stopped sending results",
+                             exc_info=consumer.exception())
+                await ws.close(code=1011, reason="Internal error.")
+            consumer.cancel()
+
+
+async def swap_model(app: Sanic, model: Model) -> None:
+    """
+    Replace the model used to serve predictions with a loaded model.
+    Requests already in flight keep the model they started with.
+    """
+    logger.info(
+        f"Swapping model: {app.ctx.model.model_path} -> {model.model_path}")
+    app.ctx.model = model
+    # Results cached for the old model are never used again.
+    cache = app.ctx.result_cache
+    if cache is not None:
+        cache.clear()
+
+
+def add_model_watcher(app: Sanic, config: Config) -> None:
+    """Swap in new models as they appear in the model directory."""
+    async def swap(model: Model) -> None:
+        await swap_model(app, model)
+
+    app.ctx.watcher = ModelWatcher.from_config(
+        config, lambda: app.ctx.model, swap)
+
+    @app.after_server_start
+    async def start_watcher(app: Sanic, loop: asyncio.AbstractEventLoop):
+        app.ctx.watcher.start()
+
+    @app.before_server_stop
+    async def stop_watcher(app: Sanic, loop: asyncio.AbstractEventLoop):
+        app.ctx.watcher.stop()
+
+
+def add_model_routes(app: Sanic, config: Config) -> None:
+    """
+    Add routes to see which models are available and to pin the model being
+    served to one of them, or roll back to the previous model.
+    """
+    model_dir = config.model_dir
+
+    def model_status() -> Dict[str, Any]:
+        pinned = get_pinned_model_file(model_dir)
+        return {
+            "model": os.path.basename(app.ctx.model.model_path or ""),
+            "pinned": pinned and os.path.basename(pinned),
+            "models": [os.path.basename(path)
+                       for path in list_model_files(model_dir)]
+        }
+
+    async def pin(model_path: Optional[str]) -> HTTPResponse:
+        previous = get_pinned_model_file(model_dir)
+        pin_model_file(model_dir, model_path)
+        try:
+            await app.ctx.watcher.check(settle=False)
+        except Exception as e:
+            pin_model_file(model_dir, previous)
+            logger.exception(f"Could not load pinned model: {model_path}")
+            return json({"status": "invalid model", "error": str(e)},
+                        status=422)
+
+        return json({"status": "ok", **model_status()})
+
+    @app.get('/model')
+    async def models(request: Request) -> HTTPResponse:
+        return json({"status": "ok", **model_status()})
+
+    @app.post('/model/pin')
+    async def pin_model(request: Request) -> HTTPResponse:
+        body = request.json
+        if not isinstance(body, dict) or \
+                not isinstance(body.get("model"), str):
+            return invalid_request(
+                'Expected a JSON body with a "model" string field.')
+
+        name = body["model"]
+        paths = {os.path.basename(path): path
+                 for path in list_model_files(model_dir)}
+        if name not in paths:
+            return json({"status": "not found"}, status=404)
+
+        return await pin(paths[name])
+
+    @app.delete('/model/pin')
+    async def unpin_model(request: Request) -> HTTPResponse:
+        return await pin(None)
+
+    @app.post('/model/rollback')
+    async def rollback(request: Request) -> HTTPResponse:
+        paths = list_model_files(model_dir)
+        names = [os.path.basename(path) for path in paths]
+        current = os.path.basename(app.ctx.model.model_path or "")
+        if current not in names or names.index(current) == 0:
+            return json({"status": "no earlier model", **model_status()},
+                        status=409)
+
+        return await pin(paths[names.index(current) - 1])
+
+
+def add_metrics_route(app: Sanic) -> None:
+    """
+    Add a route exposing the server's metrics in the Prometheus text format.
+    With several workers, each scrape is answered by one of them with the
+    metrics of them all, added up through files in a directory they share.
+    """
+    @app.main_process_start
+    async def create_metrics_dir(app: Sanic, loop: asyncio.AbstractEventLoop):
+        # Created before the workers are forked so that they all share it.
+        app.ctx.metrics_dir = None
+        if app.state.workers > 1:
+            app.ctx.metrics_dir = tempfile.mkdtemp(prefix="cornea-metrics-")
+
+    @app.main_process_stop
+    async def remove_metrics_dir(app: Sanic, loop: asyncio.AbstractEventLoop):
+        if app.ctx.metrics_dir is not None:
+            shutil.rmtree(app.ctx.metrics_dir, ignore_errors=True)
+
+    @app.before_server_start
+    async def share_metrics(app: Sanic, loop: asyncio.AbstractEventLoop):
+        app.ctx.shared_metrics = None
+        metrics_dir = getattr(app.ctx, "metrics_dir", None)
+        if metrics_dir is not None:
+            app.ctx.shared_metrics = metrics.SharedMetrics(
+                metrics.REGISTRY, metrics_dir)
+            app.ctx.shared_metrics.start()
+
+    @app.after_server_stop
+    async def stop_sharing(app: Sanic, loop: asyncio.AbstractEventLoop):
+        if app.ctx.shared_metrics is not None:
+            app.ctx.shared_metrics.stop()
+
+    def pool_stat(name: str) -> Callable[[], Optional[int]]:
+        def stat() -> Optional[int]:
+            pool = getattr(app.ctx, "pool", None)
+            return getattr(pool, name)() if pool is not None else None
+        return stat
+
+    def executor_stat(name: str) -> Callable[[], Optional[int]]:
+        def stat() -> Optional[int]:
+            executor = getattr(app.ctx, "executor", None)
+            return getattr(executor, name) if executor is not None else None
+        return stat
+
+    def cache_size() -> Optional[int]:
+        cache = app.ctx.result_cache
+        return len(cache) if cache is not None else None
+
+    for gauge in (
+        metrics.Gauge("cornea_executor_pending",
+                      "Frames running or queued in the inference executor.",
+                      executor_stat("pending")),
+        metrics.Gauge("cornea_executor_capacity",
+                      "Frames the inference executor accepts at once.",
+                      executor_stat("capacity")),
+        metrics.Gauge("cornea_db_pool_size",
+                      "Open database connections.",
+                      pool_stat("get_size")),
+        metrics.Gauge("cornea_db_pool_idle",
+                      "Open database connections not in use.",
+                      pool_stat("get_idle_size")),
+        metrics.Gauge("cornea_db_pool_max_size",
+                      "Most database connections the pool opens.",
+                      pool_stat("get_max_size")),
+        metrics.Gauge("cornea_result_cache_size",
+                      "Frames with a result in the result cache.",
+                      cache_size),
+    ):
+        metrics.REGISTRY.register(gauge)
+
+    @app.get('/metrics')
+    async def get_metrics(request: Request) -> HTTPResponse:
+        shared = getattr(app.ctx, "shared_metrics", None)
+        body = shared.render() if shared is not None else \
+            metrics.REGISTRY.render()
+        return response.text(body, content_type=metrics.CONTENT_TYPE)
+
+
+def add_profiling_routes(app: Sanic, config: Config) -> None:
     """
-    Decorator used to execute computationally intense requests in a
-    separate thread to avoid blocking the server, which would cause
-    it to be unable to process requests until the intense request has
-    completed.
+    Set up tracing of slow requests, if enabled, and add routes to get the
+    traces kept.
     """
-    @wraps(func)
-    async def inner(
-        request: Request, *args: Any, **kwargs: Any
-    ) -> HTTPResponse:
-        def run() -> HTTPResponse:
-            return asyncio.run(func(request, *args, **kwargs))
-        
-        with ThreadPoolExecutor() as pool:
-            return await request.app.loop.run_in_executor(pool, run)
+    app.ctx.profiler = Profiler.from_config(config)
+    if app.ctx.profiler is None:
+        return
+
+    @app.get('/debug/traces')
+    async def traces(request: Request) -> HTTPResponse:
+        return json({"traces": [
+            trace.to_dict() for trace in reversed(app.ctx.profiler.traces)]})
+
+    @app.get('/debug/traces/<trace_id:int>')
+    async def trace(request: Request, trace_id: int) -> HTTPResponse:
+        trace = app.ctx.profiler.get(trace_id)
+        if trace is None:
+            return json({"status": "not found"}, status=404)
+
+        return json(trace.to_dict(profile=True))
+
+
+def add_training_routes(app: Sanic, config: Config) -> None:
+    """Add routes to start background training jobs and follow them."""
+    async def on_complete(model_path: str) -> None:
+        # The new model is served unless another model has been pinned.
+        await app.ctx.watcher.check(settle=False)
+
+    app.ctx.training = TrainingManager(config, on_complete)
+
+    @app.before_server_start
+    async def allow_training(app: Sanic, loop: asyncio.AbstractEventLoop):
+        # The workers of a multi-worker server are daemon processes, which
+        # multiprocessing does not allow to start the training process. The
+        # training process is a daemon itself, so it still stops with them.
+        multiprocessing.current_process().daemon = False
+
+    @app.post('/model/train')
+    async def train(request: Request) -> HTTPResponse:
+        # The body is optional, training is not incremental by default.
+        body = request.json if request.body else {}
+        if not isinstance(body, dict) or \
+                not isinstance(body.get("incremental", False), bool):
+            return invalid_request(
+                'Expected a JSON body with an optional "incremental" '
+                'boolean field.')
+
+        incremental = body.get("incremental", False)
+        try:
+            job = app.ctx.training.start(incremental)
+        except JobAlreadyRunning as e:
+            return json({"status": "busy", "job": e.job.to_dict()}, status=409)
+
+        return json({"status": "accepted", "job": job.to_dict()}, status=202)
+
+    @app.get('/model/train/<job_id>')
+    async def train_status(request: Request, job_id: str) -> HTTPResponse:
+        job = app.ctx.training.get(job_id)
+        if job is None:
+            return json({"status": "not found"}, status=404)
+
+        return json({"status": "ok", "job": job.to_dict()})
 
 
 def create_server(
         model: Model,
-        config: Dict[Any, Any]
+        config: Config
 ) -> Sanic:
     app.ctx.config = config
     app.ctx.model = model
+    app.ctx.trackers = TrackerRegistry.from_config(config)
+    app.ctx.result_cache = ResultCache.from_config(config)
 
     add_root_route(app)
+    add_executor(app, config)
+    add_database(app, config)
+    add_frame_errors(app)
+    add_model_watcher(app, config)
+    add_model_routes(app, config)
+    add_training_routes(app, config)
+    add_metrics_route(app)
+    add_profiling_routes(app, config)
+    add_stream_route(app)
 
     @app.post('/model/detect_frame')
     async def detect_frame(request: Request) -> HTTPResponse:
-        data = request.json
-        decoded = base64.b64decode(bytes(data["frame"], encoding='utf8'))
-        result = await model.handle_frame(decoded)
-
-        match_data: dict
-        if result is None:
-            match_data = {
-                "tag": "Unknown",
-                "confidence": 0,
-                "position": {
-                    "x": 0,
-                    "y": 0,
-                    "w": 0,
-                    "h": 0
-                }
-            }
-            return json(body=match_data)
-        
-        match_data = {
-            "tag": result[0],
-            "confidence": result[1],
-            "position": result[2]
-        }
+        profiler = app.ctx.profiler
+        trace = None
+        if profiler is not None:
+            trace = profiler.start(
+                request.path, request.headers.get(PROFILE_HEADER))
+        if trace is None:
+            return await handle_detect_frame(request)
 
-        return json(body=match_data)
-    
-    @threaded_request
-    @app.post('/model/train')
-    async def train(request: Request) -> HTTPResponse:
         try:
-            faces = await database.all_faces(app.ctx.conn)
-            app.ctx.model.train(faces)
+            response = await handle_detect_frame(request)
+        finally:
+            kept = profiler.finish(trace)
+        if kept:
+            response.headers[TRACE_HEADER] = str(trace.id)
+        return response
+
+    async def handle_detect_frame(request: Request) -> HTTPResponse:
+        with STAGE_SECONDS.time(stage="parse"):
+            frame = parse_frame(request)
+        stream_id = request.headers.get(STREAM_ID_HEADER)
+        result = await run_detection(app, frame, stream_id)
+
+        with STAGE_SECONDS.time(stage="serialise"):
+            return json(body=format_faces(result, app.ctx.people))
 
-            return json({"status": "ok"})
-        except SanicException:
-            return json({"status": "fail"})
+    max_batch_size = config.inference.get(
+        "max_batch_size", DEFAULT_MAX_BATCH_SIZE)
 
+    @app.post('/model/detect_frames')
+    async def detect_frames(request: Request) -> HTTPResponse:
+        with STAGE_SECONDS.time(stage="parse"):
+            size = get_frame_size(request)
+            batch = parse_frame_batch(request)
+        # A batch larger than the executor can ever take would only be
+        # turned away as busy.
+        limit = min(max_batch_size, app.ctx.executor.capacity)
+        if len(batch) > limit:
+            return json({"status": "too many frames",
+                         "max_batch_size": limit}, status=413)
+
+        model = app.ctx.model
+        people = app.ctx.people
+        cache = app.ctx.result_cache
+
+        def detect(data: Union[bytes, memoryview]) -> Dict[str, Any]:
+            # A bad frame from one camera should not fail the whole batch.
+            try:
+                frame = Frame(data, *size) if size else Frame(data)
+                if cache is not None:
+                    result = cache.handle_frame(model, frame)
+                else:
+                    result = model.handle_frame(frame)
+            except InvalidFrame as e:
+                return {"status": "invalid frame", "error": str(e)}
+            except Exception:
+                logger.exception("Could not process frame of batch")
+                return {"status": "error"}
+            return {"status": "ok", **format_faces(result, people)}
+
+        results = await app.ctx.executor.map(detect, batch)
+        with STAGE_SECONDS.time(stage="serialise"):
+            return json({"results": results})
+    
     return app
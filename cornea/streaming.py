@@ -0,0 +1,65 @@
+from __future__ import annotations
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, Generic, Optional, Tuple, \
+    TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class LatestFrameStream(Generic[T]):
+    """
+    Processes the frames pushed by a single client one at a time, always
+    taking the most recent one.
+
+    Frames which arrive while another is being processed replace the one
+    waiting rather than queueing behind it, so if the server falls behind a
+    camera the stale frames are dropped and the results the client receives
+    never lag more than one frame behind.
+    """
+    def __init__(
+            self,
+            process: Callable[[int, T], Awaitable[Dict[str, Any]]],
+            send: Callable[[Dict[str, Any]], Awaitable[None]]
+    ) -> None:
+        self._process = process
+        self._send = send
+        self._pending: Optional[Tuple[int, T]] = None
+        self._ready = asyncio.Event()
+        self._closed = False
+        self.received = 0
+        self.processed = 0
+        self.dropped = 0
+
+    def push(self, frame: T) -> None:
+        """Hand a new frame to the stream, dropping any frame still waiting."""
+        self.received += 1
+        if self._pending is not None:
+            self.dropped += 1
+        self._pending = (self.received, frame)
+        self._ready.set()
+
+    def close(self) -> None:
+        """Stop once the frame currently being processed is finished."""
+        self._closed = True
+        self._pending = None
+        self._ready.set()
+
+    async def run(self) -> None:
+        """Process and send results for frames until the stream is closed."""
+        while not self._closed:
+            await self._ready.wait()
+            self._ready.clear()
+            if self._pending is None:
+                continue
+
+            seq, frame = self._pending
+            self._pending = None
+            result = await self._process(seq, frame)
+            self.processed += 1
+            await self._send(result)
+
+        logger.debug(f"Stream closed after {self.received} frames, "
+                     f"{self.dropped} dropped")
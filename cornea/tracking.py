@@ -0,0 +1,211 @@
+from __future__ import annotations
+import time
+import logging
+import threading
+from typing import Any, Dict, List, Optional, Union
+
+import numpy as np
+from numpy.typing import NDArray
+
+from cornea.frame import Frame
+from cornea.model import Model, Match
+from cornea.detection import Region
+from cornea.motion import MotionGate
+from cornea.config import Config
+from cornea.metrics import STREAM_FRAMES, STREAM_FRAMES_SKIPPED
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DETECT_INTERVAL = 10
+DEFAULT_MARGIN = 0.5
+DEFAULT_MIN_CONFIDENCE = 0.0
+DEFAULT_IDLE_TIMEOUT = 30.0
+
+# How much a tracked face may grow or shrink from one frame to the next.
+SIZE_TOLERANCE = 0.3
+
+
+class FaceTracker:
+    """
+    Follows the faces in a single video stream from one frame to the next.
+
+    Faces are searched for in the whole frame, and each one recognised, only
+    every detect_interval frames. In the frames between, each face is only
+    searched for in a small region around where it was last seen and keeps
+    the identity it was given, which is far cheaper than detecting and
+    recognising faces from scratch. If a face cannot be found again, the
+    whole frame is searched immediately. Faces entering the frame are found
+    at the next full detection.
+
+    If the stream has a motion gate, frames in which nothing has moved are
+    not searched at all, and are given the faces of the frame before.
+    """
+    def __init__(
+            self,
+            detect_interval: int = DEFAULT_DETECT_INTERVAL,
+            margin: float = DEFAULT_MARGIN,
+            min_confidence: float = DEFAULT_MIN_CONFIDENCE,
+            stream_id: Optional[str] = None,
+            gate: Optional[MotionGate] = None
+    ) -> None:
+        self.detect_interval = max(1, detect_interval)
+        self.margin = margin
+        self.min_confidence = min_confidence
+        self.stream_id = stream_id
+        self.gate = gate
+        self.tracks: List[Match] = []
+        self.last_seen = time.monotonic()
+        self._model: Optional[Model] = None
+        self._countdown = 0
+        # Frames from the same stream may be handled by different workers.
+        self._lock = threading.Lock()
+
+    def handle_frame(
+            self,
+            model: Model,
+            frame: Union[bytes, Frame],
+            region: Optional[Region] = None) -> List[Match]:
+        """
+        Find and recognise the faces in the next frame of the stream, or in
+        a region of it, returning a result in the same form as
+        Model.handle_frame.
+        """
+        with self._lock:
+            self.last_seen = time.monotonic()
+            image = model.decode_frame(frame)
+
+            # Identities given by a previous model are no longer valid.
+            if model is not self._model:
+                self._model = model
+                self._countdown = 0
+            elif self.gate is not None and not self.gate.moved(image, region):
+                STREAM_FRAMES_SKIPPED.inc(stream=self.stream_id or "")
+                return model.to_frame_coordinates(self.tracks)
+
+            if self._countdown > 0:
+                tracks = self._follow(model, image)
+                if tracks is not None:
+                    self._countdown -= 1
+                    self.tracks = tracks
+                    return model.to_frame_coordinates(tracks)
+
+            self.tracks = [model.predict_face(image, box)
+                           for box in model.detect_faces(image, region)]
+            self._countdown = self.detect_interval - 1
+            return model.to_frame_coordinates(self.tracks)
+
+    def _follow(
+            self,
+            model: Model,
+            image: NDArray[np.uint8]) -> Optional[List[Match]]:
+        """
+        Find each tracked face again near its last location. Returns None if
+        any of them has been lost.
+        """
+        height, width = image.shape[:2]
+        tracks = []
+
+        for tag, confidence, location in self.tracks:
+            x, y = location["x"], location["y"]
+            w, h = location["w"], location["h"]
+
+            # Search a region around the face for a face of a similar size.
+            left = max(0, int(x - w * self.margin))
+            top = max(0, int(y - h * self.margin))
+            right = min(width, int(x + w + w * self.margin))
+            bottom = min(height, int(y + h + h * self.margin))
+            min_side = int(min(w, h) * (1 - SIZE_TOLERANCE))
+            max_side = int(max(w, h) * (1 + SIZE_TOLERANCE)) + 1
+
+            faces = model.detect_faces(
+                image,
+                region=(left, top, right - left, bottom - top),
+                min_size=min_side,
+                max_size=max_side
+            )
+            if len(faces) == 0:
+                return None
+
+            # Take the face closest to where the tracked face was.
+            centre = np.array([x + w / 2, y + h / 2])
+            distances = np.linalg.norm(
+                faces[:, :2] + faces[:, 2:] / 2 - centre, axis=1)
+            fx, fy, fw, fh = faces[int(np.argmin(distances))]
+            box = (int(fx), int(fy), int(fw), int(fh))
+
+            if confidence < self.min_confidence:
+                tracks.append(model.predict_face(image, box))
+                continue
+
+            tracks.append((tag, confidence, {
+                "x": box[0], "y": box[1], "w": box[2], "h": box[3]
+            }))
+
+        return tracks
+
+
+class TrackerRegistry:
+    """
+    Keeps a FaceTracker for each stream which is sending frames, keyed by
+    the id the client gives the stream, and forgets streams which have gone
+    quiet. Streams get a motion gate if the motion_gate settings enable one
+    for them.
+    """
+    def __init__(
+            self,
+            detect_interval: int = DEFAULT_DETECT_INTERVAL,
+            margin: float = DEFAULT_MARGIN,
+            min_confidence: float = DEFAULT_MIN_CONFIDENCE,
+            idle_timeout: float = DEFAULT_IDLE_TIMEOUT,
+            motion_gate: Optional[Dict[str, Any]] = None
+    ) -> None:
+        self.detect_interval = detect_interval
+        self.margin = margin
+        self.min_confidence = min_confidence
+        self.idle_timeout = idle_timeout
+        self.motion_gate = motion_gate or {}
+        self._trackers: Dict[str, FaceTracker] = {}
+
+    @classmethod
+    def from_config(cls, config: Config) -> TrackerRegistry:
+        """
+        Create a registry from the tracking and motion_gate sections of the
+        config.
+        """
+        tracking = config.tracking
+        return cls(
+            detect_interval=tracking.get(
+                "detect_interval", DEFAULT_DETECT_INTERVAL),
+            margin=tracking.get("margin", DEFAULT_MARGIN),
+            min_confidence=tracking.get(
+                "min_confidence", DEFAULT_MIN_CONFIDENCE),
+            idle_timeout=tracking.get("idle_timeout", DEFAULT_IDLE_TIMEOUT),
+            motion_gate=config.motion_gate
+        )
+
+    def __len__(self) -> int:
+        return len(self._trackers)
+
+    def get(self, stream_id: str) -> FaceTracker:
+        """Get the tracker of a stream, starting a new one if needed."""
+        self._expire()
+
+        tracker = self._trackers.get(stream_id)
+        if tracker is None:
+            logger.debug(f"Tracking new stream: {stream_id}")
+            tracker = FaceTracker(
+                self.detect_interval, self.margin, self.min_confidence,
+                stream_id=stream_id,
+                gate=MotionGate.for_stream(self.motion_gate, stream_id))
+            self._trackers[stream_id] = tracker
+
+        return tracker
+
+    def _expire(self) -> None:
+        cutoff = time.monotonic() - self.idle_timeout
+        for stream_id, tracker in list(self._trackers.items()):
+            if tracker.last_seen < cutoff:
+                logger.debug(f"Forgetting idle stream: {stream_id}")
+                del self._trackers[stream_id]
+                STREAM_FRAMES.remove(stream=stream_id)
+                STREAM_FRAMES_SKIPPED.remove(stream=stream_id)
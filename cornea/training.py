@@ -1,27 +1,32 @@
 import os
+import time
+import asyncio
 import logging
-from typing import Optional, List, Tuple
-from PIL import Image
-from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, List, Tuple, AsyncIterator
 
 import numpy as np
 from numpy.typing import NDArray
 
 from cornea import database
-from cornea.database import Connection
-from cornea.model import Model
+from cornea.database import Pool, Connection
+from cornea.model import Model, ProgressCallback
+from cornea.preparation import FaceExtractor
 
 logger = logging.getLogger(__name__)
 
 ACCEPTED_EXTENSIONS= (".jpg", ".jpeg")
 
+DEFAULT_INGEST_BATCH_SIZE = 100
+DEFAULT_INGEST_READERS = 8
+
 
 def load_training_file(path: str) -> Optional[bytes]:
     """Load an image from the filesystem"""
     if not os.path.exists(os.path.abspath(path)):
         return
     
-    logger.info(f"Loading file at path: {path}")
+    logger.debug(f"Loading file at path: {path}")
     try:
         with open(path, 'rb') as image:
             image_data = image.read()
@@ -59,17 +64,255 @@ def load_training_folder(path: str, tag: int) -> List[Tuple[bytes, int]]:
     return images
 
 
-async def ingest_training_data(
+def _serialise_crops(
+        crops: List[NDArray[np.uint8]]) -> List[Tuple[bytes, int, int]]:
+    return [(crop.tobytes(), crop.shape[1], crop.shape[0]) for crop in crops]
+
+
+def list_training_folder(path: str) -> List[str]:
+    """List the paths of the training images in a folder, in name order."""
+    return [os.path.join(path, image) for image in sorted(os.listdir(path))
+            if image.lower().endswith(ACCEPTED_EXTENSIONS)]
+
+
+async def iter_training_folder(
+        path: str,
+        tag: int,
+        batch_size: int = DEFAULT_INGEST_BATCH_SIZE,
+        readers: int = DEFAULT_INGEST_READERS
+) -> AsyncIterator[List[Tuple[bytes, int]]]:
+    """
+    Stream the images in a training folder in batches of batch_size.
+    Files are read by a pool of reader threads and the next batch is read
+    while the current one is being processed, so at most two batches are
+    held in memory at a time.
+    """
+    files = list_training_folder(path)
+    batches = [files[i:i + batch_size]
+               for i in range(0, len(files), batch_size)]
+    loop = asyncio.get_running_loop()
+
+    with ThreadPoolExecutor(
+            max_workers=readers,
+            thread_name_prefix="cornea-ingest") as executor:
+        def read(batch: List[str]) -> asyncio.Future:
+            return asyncio.gather(*[
+                loop.run_in_executor(executor, load_training_file, image)
+                for image in batch
+            ])
+
+        pending = read(batches[0]) if batches else None
+        for i, batch in enumerate(batches):
+            images = await pending
+            if i + 1 < len(batches):
+                pending = read(batches[i + 1])
+
+            entries = []
+            for image, image_data in zip(batch, images):
+                if image_data is None:
+                    logger.warning(f'Unable to load training image for tag: '
+                                   f'{tag} at path {image}.')
+                    continue
+                entries.append((image_data, tag))
+            yield entries
+
+
+async def _write_training_batch(
         conn: Connection,
+        extractor: FaceExtractor,
         data: List[Tuple[bytes, int]]) -> None:
-    """Ingest loaded image data into the database"""
+    """Extract the face crops from a batch of images and write them."""
+    all_crops = extractor.extract([entry[0] for entry in data])
+
+    faces = []
+    for (image_data, tag), crops in zip(data, all_crops):
+        if not crops:
+            logger.warning(f"No faces found in training image for tag: {tag}")
+        faces.append((tag, image_data, _serialise_crops(crops)))
+
+    await database.copy_faces(conn, faces)
+
+
+def _log_throughput(images: int, size: int, elapsed: float) -> None:
+    elapsed = max(elapsed, 1e-9)
+    megabytes = size / (1024 * 1024)
+    logger.info(f"Ingested {images} images ({megabytes:.1f} MB) in "
+                f"{elapsed:.2f}s: {images / elapsed:.1f} images/s, "
+                f"{megabytes / elapsed:.2f} MB/s")
+
+
+async def ingest_training_folder(
+        pool: Pool,
+        path: str,
+        tag: int,
+        model: Model) -> None:
+    """
+    Ingest a folder of training images for one person into the database.
+    Images are streamed from disk and written in batches with COPY inside a
+    single transaction, so either the whole folder is ingested or nothing.
+    """
+    if not os.path.isdir(path):
+        logger.error(f"Training folder does not exist: {path}")
+        return
+
+    actor = await database.get_person_by_tag(pool, tag)
+    if actor is None:
+        logger.warning(f"No person exists to map to tag: {tag}")
+        return
+
+    ingest_config = model.config.ingest
+    batch_size = ingest_config.get("batch_size", DEFAULT_INGEST_BATCH_SIZE)
+    readers = ingest_config.get("readers", DEFAULT_INGEST_READERS)
+    workers = model.config.training.get("workers")
+
+    logger.info(f"Ingesting training data for tag: {tag} from {path}")
+    images = 0
+    size = 0
+    started = time.perf_counter()
+    with FaceExtractor(model, workers) as extractor:
+        async with database.acquire(pool) as conn, conn.transaction():
+            async for batch in iter_training_folder(
+                    path, tag, batch_size, readers):
+                await _write_training_batch(conn, extractor, batch)
+                images += len(batch)
+                size += sum(len(entry[0]) for entry in batch)
+                logger.debug(f"Ingested {images} images")
+
+    _log_throughput(images, size, time.perf_counter() - started)
+
+
+async def ingest_training_data(
+        pool: Pool,
+        data: List[Tuple[bytes, int]],
+        model: Model) -> None:
+    """
+    Ingest loaded image data into the database, along with the face crops
+    found in each image so that training does not need to find them again.
+    """
     logger.info("Ingesting training data to database")
     tag = data[0][1]
 
-    actor = await database.get_person_by_tag(conn, 1)
+    actor = await database.get_person_by_tag(pool, tag)
     if actor is None:
         logger.warning(f"No person exists to map to tag: {tag}")
         return
 
-    for entry in data:
-        await database._write_face(conn, tag, entry[0])
+    batch_size = model.config.ingest.get(
+        "batch_size", DEFAULT_INGEST_BATCH_SIZE)
+    workers = model.config.training.get("workers")
+
+    started = time.perf_counter()
+    with FaceExtractor(model, workers) as extractor:
+        async with database.acquire(pool) as conn, conn.transaction():
+            for i in range(0, len(data), batch_size):
+                await _write_training_batch(
+                    conn, extractor, data[i:i + batch_size])
+
+    _log_throughput(len(data), sum(len(entry[0]) for entry in data),
+                    time.perf_counter() - started)
+
+
+async def extract_face_crops(
+        pool: Pool,
+        model: Model,
+        progress: Optional[ProgressCallback] = None,
+        chunk_size: int = database.DEFAULT_CHUNK_SIZE) -> None:
+    """
+    Extract and store the face crops of faces which were ingested without
+    them. This only has to happen once for each face.
+    """
+    extracted = 0
+    extractor = None
+    try:
+        async for chunk in database.iter_faces_without_crops(
+                pool, chunk_size):
+            if extractor is None:
+                logger.info("Extracting face crops from stored faces")
+                extractor = FaceExtractor(
+                    model, model.config.training.get("workers"))
+
+            all_crops = extractor.extract([entry[1] for entry in chunk])
+            for (face_id, _, tag), crops in zip(chunk, all_crops):
+                await database.write_face_crops(
+                    pool, face_id, tag, _serialise_crops(crops))
+            extracted += len(chunk)
+
+            if progress is not None:
+                progress({"stage": "extracting", "faces_extracted": extracted})
+    finally:
+        if extractor is not None:
+            extractor.close()
+
+
+async def train_model(
+        pool: Pool,
+        model: Model,
+        progress: Optional[ProgressCallback] = None,
+        reload: bool = True,
+        incremental: bool = False) -> str:
+    """
+    Train a new model from every face in the database.
+    If incremental is set, only the faces added since the latest model was
+    trained are added to it, falling back to a full retrain if there is no
+    model to update or it does not record which faces it contains.
+
+    Face crops are streamed from the database and fitted one chunk at a time,
+    so memory use is bounded by the training.prefetch setting rather than by
+    the size of the training set.
+    Returns the path of the newly written model.
+    """
+    chunk_size = model.config.training.get(
+        "prefetch", database.DEFAULT_CHUNK_SIZE)
+    if progress is not None:
+        progress({"stage": "loading"})
+
+    # Faces added while training is in progress are left for the next run.
+    await extract_face_crops(pool, model, progress, chunk_size)
+    until = await database.claim_face_crops(pool)
+
+    if incremental and not model.loaded:
+        try:
+            model._load_model()
+        except RuntimeError:
+            logger.info("No model to update, training a new model.")
+
+    after = 0
+    update = False
+    if incremental and model.loaded and model.generation is not None:
+        after = model.generation
+        if after >= until:
+            logger.info(f"Model {model.model_path} is already up to date.")
+            return str(model.model_path)
+
+        logger.info(f"Updating model {model.model_path} with the faces of "
+                    f"generations {after + 1} to {until}.")
+        update = True
+    elif incremental:
+        logger.info("Latest model cannot be updated incrementally, training "
+                    "a new model.")
+
+    if not update:
+        logger.info("Training OpenCV model, this may take a while.")
+
+    total = await database.count_face_crops(pool, after, until)
+    processed = 0
+    samples = 0
+    async for chunk in database.iter_face_crops(
+            pool, after, until, chunk_size):
+        # Every chunk after the first is added to what was already fitted.
+        samples += model.fit(chunk, update=update or samples > 0)
+        processed += len(chunk)
+
+        if progress is not None:
+            progress({
+                "stage": "preparing",
+                "records_processed": processed,
+                "records_total": total,
+                "samples_prepared": samples
+            })
+
+    if not samples and not update:
+        raise RuntimeError("No face crops were found to train on.")
+    logger.info(f"Fitted {samples} samples.")
+
+    return model.save(progress=progress, reload=reload, generation=until)
@@ -0,0 +1,145 @@
+from __future__ import annotations
+import os
+import asyncio
+import logging
+from typing import Awaitable, Callable, Optional, Tuple
+
+import numpy as np
+
+from cornea.model import Model, FACE_SIZE, get_serving_model_file
+from cornea.config import Config
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_INTERVAL = 5.0
+
+# The size and modification time of a file, used to tell when it changes.
+FileState = Tuple[int, float]
+
+
+def _file_state(path: str) -> Optional[FileState]:
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_size, stat.st_mtime
+
+
+def load_verified_model(model_path: str, config: Config) -> Model:
+    """
+    Load a model file and check that it can make a prediction, raising an
+    exception if it cannot.
+    """
+    model = Model.from_file(model_path, config)
+    if model.index is None or not len(model.index):
+        raise RuntimeError(f"Model has no samples: {model_path}")
+
+    model.index.predict(np.zeros(FACE_SIZE[::-1], dtype=np.uint8))
+    return model
+
+
+class ModelWatcher:
+    """
+    Watches the model directory and swaps the model being served for the
+    pinned model, or the latest one if none is pinned, whenever that
+    changes. The directory is polled rather than watched with inotify so
+    that it works on any file system, including network mounts.
+
+    Models are loaded and verified in the background and only swapped in
+    once they are ready, so requests always see a complete model. A model
+    copied into the directory is not loaded until it has stopped changing
+    between two checks, and a model which fails to load is not tried again
+    until the file changes.
+    """
+    def __init__(
+            self,
+            config: Config,
+            current: Callable[[], Model],
+            swap: Callable[[Model], Awaitable[None]],
+            interval: float = DEFAULT_INTERVAL
+    ) -> None:
+        self.config = config
+        self.interval = interval
+        self._current = current
+        self._swap = swap
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        # The model waiting to settle and the model which failed to load.
+        self._settling: Optional[Tuple[str, FileState]] = None
+        self._failed: Optional[Tuple[str, FileState]] = None
+
+    @classmethod
+    def from_config(
+            cls,
+            config: Config,
+            current: Callable[[], Model],
+            swap: Callable[[Model], Awaitable[None]]) -> ModelWatcher:
+        """Create a watcher from the model_watcher section of the config."""
+        interval = config.model_watcher.get("interval", DEFAULT_INTERVAL)
+        return cls(config, current, swap, interval)
+
+    def start(self) -> None:
+        """Start checking the model directory in the background."""
+        if self.interval and self._task is None:
+            logger.info(f"Watching for new models in {self.config.model_dir} "
+                        f"every {self.interval}s")
+            self._task = asyncio.ensure_future(self._watch())
+
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _watch(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.check()
+            except Exception:
+                logger.exception("Could not load new model")
+
+    def is_serving(self, model_path: str) -> bool:
+        """Check whether a model file is the one being served."""
+        current = self._current().model_path
+        return current is not None and \
+            os.path.abspath(model_path) == os.path.abspath(current)
+
+    async def check(self, settle: bool = True) -> bool:
+        """
+        Swap in the model which should be served if it is not already being
+        served. Unless settle is unset, a model is only loaded once it has
+        not changed since the last check.
+        Returns whether the model was swapped, or raises the exception which
+        prevented the model from being loaded.
+        """
+        async with self._lock:
+            model_path = get_serving_model_file(self.config.model_dir)
+            if model_path is None or self.is_serving(model_path):
+                self._settling = None
+                return False
+
+            # Models which failed to load are only retried when asked to.
+            state = _file_state(model_path)
+            if state is None or \
+                    (settle and (model_path, state) == self._failed):
+                return False
+
+            if settle and self._settling != (model_path, state):
+                self._settling = (model_path, state)
+                return False
+            self._settling = None
+
+            return await self._load(model_path, state)
+
+    async def _load(self, model_path: str, state: FileState) -> bool:
+        loop = asyncio.get_running_loop()
+        try:
+            model = await loop.run_in_executor(
+                None, load_verified_model, model_path, self.config)
+        except Exception:
+            self._failed = (model_path, state)
+            raise
+
+        self._failed = None
+        await self._swap(model)
+        return True
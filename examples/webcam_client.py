@@ -1,21 +1,15 @@
 # A really simple application example where we send webcam
-# frames to Cornea's REST API. We are not using a database and
-# we are just mapping the returned tags from the model to people's
-# names.
+# frames to Cornea's REST API and label each face with the name
+# of the person Cornea recognised.
 
 import cv2
 import requests
 
-import base64
-
 # Default display font for the output window.
 DEFAULT_DISPLAY_FONT = cv2.FONT_HERSHEY_SIMPLEX
 # Set this to the API URI you are using for your Cornea instance.
 CORNEA_API_URI = "http://0.0.0.0:8000/model/detect_frame"
 
-# Our array of people.
-names = ["Person1", "Person2", "Person3"]
-
 
 def main():
     # Create a webcam capture using OpenCV.
@@ -27,59 +21,64 @@ def main():
     while True:
         # Read a frame from the capture.
         ret, img = cap.read()
-        # Encode the incoming webcam image to JPG and then encode the image
-        # to a base 64 bytestring.
+        # Encode the incoming webcam image to JPG.
         image = cv2.imencode('.jpg', img)[1]
-        image_b64 = str(base64.b64encode(image), encoding='utf8')
 
-        # Send request containing the encoded image to the API.
+        # Send the encoded image to the API as the request body, this avoids
+        # the overhead of base 64 encoding it into JSON.
         res = requests.post(url=CORNEA_API_URI,
-                            json={"frame": image_b64}).json()
+                            data=image.tobytes(),
+                            headers={"Content-Type": "image/jpeg"}).json()
         # Print returned JSON
         print(res)
 
-        p = res["position"]
-        # Create a blue rectangle around the detected face. The API will
-        # return the face coordinates for the current frame before we show it
-        # so we can use that as coordinate data.
-        cv2.rectangle(
-            img,
-            (p["x"], p["y"]),
-            ((p["x"] + p["w"]), (p["y"] + p["h"])),
-            (255, 0, 0),
-            2
-        )
+        # Draw every face the API found in the frame.
+        for face in res["faces"]:
+            p = face["position"]
+            # Create a blue rectangle around the detected face. The API will
+            # return the face coordinates for the current frame before we
+            # show it so we can use that as coordinate data.
+            cv2.rectangle(
+                img,
+                (p["x"], p["y"]),
+                ((p["x"] + p["w"]), (p["y"] + p["h"])),
+                (255, 0, 0),
+                2
+            )
+
+            if (confidence := face["confidence"]) > 0.5:
+                # Confidence is returned between 0 and 1 so multiply by 100
+                # and round to get the percentage confidence value for this
+                # face.
+                confidence_str = f"{round(confidence * 100)}%"
+                # The name is None if the person has no name in the
+                # database yet.
+                id_str = face["name"] or f"Tag {face['tag']}"
+            else:
+                confidence_str = "???"
+                id_str = "UNKNOWN"
 
-        if confidence := res["confidence"] > 0.5:
-            # Confidence is returned between 0 and 1 so multiply by 100 and
-            # round to get the percentage confidence value for this frame.
-            confidence_str = f"{round(confidence * 100)}%"
-            id_str = names[res["tag"] - 1]
-        else:
-            confidence_str = "???"
-            id_str = "UNKNOWN"
-        
-        # Put text above the top left of the face.
-        cv2.putText(
-            img,
-            str(id_str),
-            (p["x"] + 5, p["y"] - 5),
-            DEFAULT_DISPLAY_FONT,
-            1,
-            (255, 255, 255),
-            2
-        )
+            # Put text above the top left of the face.
+            cv2.putText(
+                img,
+                str(id_str),
+                (p["x"] + 5, p["y"] - 5),
+                DEFAULT_DISPLAY_FONT,
+                1,
+                (255, 255, 255),
+                2
+            )
 
-        # Put the confidence underneath the bottom left of the face.
-        cv2.putText(
-            img,
-            str(confidence_str),
-            (p["x"] + 5, p["y"] + p["h"] - 5),
-            DEFAULT_DISPLAY_FONT,
-            1,
-            (255, 255, 0),
-            1
-        )
+            # Put the confidence underneath the bottom left of the face.
+            cv2.putText(
+                img,
+                str(confidence_str),
+                (p["x"] + 5, p["y"] + p["h"] - 5),
+                DEFAULT_DISPLAY_FONT,
+                1,
+                (255, 255, 0),
+                1
+            )
 
         # Show the current frame to the window and wait for CTRL-C
         cv2.imshow('camera', img)